@@ -1,6 +1,11 @@
+import os
+import pickle
+import weakref
 import torch as th
 import numpy as np
 from types import SimpleNamespace as SN
+from .segment_tree import SumTree, MinTree
+from .transforms import PackBits
 
 
 class EpisodeBatch:
@@ -18,6 +23,7 @@ class EpisodeBatch:
         self.max_seq_length = max_seq_length
         self.preprocess = {} if preprocess is None else preprocess
         self.device = device
+        self.packbits = self._setup_packbits(self.scheme)
 
         if data is not None:
             self.data = data
@@ -69,10 +75,27 @@ class EpisodeBatch:
             else:
                 shape = vshape
 
+            if field_key in self.packbits:
+                # 0/1 fields flagged with "packbits" are stored 8 flags per byte
+                shape, dtype = self.packbits[field_key].infer_output_info(shape, dtype)
+
             if episode_const:
-                self.data.episode_data[field_key] = th.zeros((batch_size, *shape), dtype=dtype, device=self.device)
+                self.data.episode_data[field_key] = self._alloc(field_key, (batch_size, *shape), dtype, episode_const)
             else:
-                self.data.transition_data[field_key] = th.zeros((batch_size, max_seq_length, *shape), dtype=dtype, device=self.device)
+                self.data.transition_data[field_key] = self._alloc(field_key, (batch_size, max_seq_length, *shape), dtype, episode_const)
+
+    def _alloc(self, field_key, shape, dtype, episode_const):
+        # storage for a single scheme field, subclasses can change the layout or backing memory
+        return th.zeros(shape, dtype=dtype, device=self.device)
+
+    def _setup_packbits(self, scheme):
+        packbits = {}
+        for field_key, field_info in scheme.items():
+            if field_info.get("packbits", False):
+                vshape = field_info["vshape"]
+                n_bits = vshape if isinstance(vshape, int) else vshape[-1]
+                packbits[field_key] = PackBits(n_bits, field_info.get("dtype", th.float32))
+        return packbits
 
     def extend(self, scheme, groups=None):
         self._setup_data(scheme, self.groups if groups is None else groups, self.batch_size, self.max_seq_length)
@@ -100,7 +123,13 @@ class EpisodeBatch:
                 raise KeyError("{} not found in transition or episode data".format(k))
 
             dtype = self.scheme[k].get("dtype", th.float32)
-            v = th.tensor(v, dtype=dtype, device=self.device)
+            if isinstance(v, th.Tensor):
+                # avoid th.tensor's unconditional copy when the data is already a tensor
+                v = v.to(device=self.device, dtype=dtype)
+            else:
+                v = th.tensor(v, dtype=dtype, device=self.device)
+            if k in self.packbits:
+                v = self.packbits[k].transform(v)
             self._check_safe_view(v, target[k][_slices])
             target[k][_slices] = v.view_as(target[k][_slices])
 
@@ -123,11 +152,14 @@ class EpisodeBatch:
     def __getitem__(self, item):
         if isinstance(item, str):
             if item in self.data.episode_data:
-                return self.data.episode_data[item]
+                v = self.data.episode_data[item]
             elif item in self.data.transition_data:
-                return self.data.transition_data[item]
+                v = self.data.transition_data[item]
             else:
                 raise ValueError
+            if item in self.packbits:
+                return self.packbits[item].inverse_transform(v)
+            return v
         elif isinstance(item, tuple) and all([isinstance(it, str) for it in item]):
             new_data = self._new_data_sn()
             for key in item:
@@ -203,21 +235,101 @@ class EpisodeBatch:
                                                                                      self.scheme.keys(),
                                                                                      self.groups.keys())
 
+class EpisodeBatchView:
+    """
+    Lightweight read-only batch returned by ReplayBuffer.sample.
+    Shares scheme/groups with the buffer instead of rebuilding an EpisodeBatch, and its
+    tensors may live in the buffer's reusable sample arena, so a view is only valid
+    until the next call to sample().
+    """
+    def __init__(self, scheme, groups, batch_size, max_seq_length, data, device, ep_ids=None, weights=None,
+                 packbits=None):
+        self.scheme = scheme
+        self.groups = groups
+        self.batch_size = batch_size
+        self.max_seq_length = max_seq_length
+        self.data = data
+        self.device = device
+        # buffer slots the episodes were drawn from and their importance sampling weights (if prioritized)
+        self.ep_ids = ep_ids
+        self.weights = weights
+        # bit-packed fields still to be unpacked (on first access, after any device move)
+        self._packed = {} if packbits is None else dict(packbits)
+
+    def __getitem__(self, item):
+        for target in (self.data.episode_data, self.data.transition_data):
+            if item in target:
+                if item in self._packed:
+                    target[item] = self._packed.pop(item).inverse_transform(target[item])
+                return target[item]
+        raise KeyError("Unrecognised key {}".format(item))
+
+    def to(self, device, non_blocking=False):
+        for k, v in self.data.transition_data.items():
+            self.data.transition_data[k] = v.to(device, non_blocking=non_blocking)
+        for k, v in self.data.episode_data.items():
+            self.data.episode_data[k] = v.to(device, non_blocking=non_blocking)
+        if self.weights is not None:
+            self.weights = self.weights.to(device, non_blocking=non_blocking)
+        self.device = device
+
+    def max_t_filled(self):
+        return th.sum(self.data.transition_data["filled"], 1).max(0)[0]
+
+    def __repr__(self):
+        return "EpisodeBatchView. Batch Size:{} Max_seq_len:{} Keys:{} Groups:{}".format(self.batch_size,
+                                                                                         self.max_seq_length,
+                                                                                         self.scheme.keys(),
+                                                                                         self.groups.keys())
+
+
+def _remove_storage(storage_dir, paths):
+    # deletes the memory-mapped files of a replay buffer, and storage_dir once it is empty
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    try:
+        os.rmdir(storage_dir)
+    except OSError:
+        pass
+
+
 class ReplayBuffer(EpisodeBatch):
-    def __init__(self, scheme, groups, buffer_size, max_seq_length, preprocess=None, device="cpu"):
+    def __init__(self, scheme, groups, buffer_size, max_seq_length, preprocess=None, device="cpu", pin_memory=False,
+                 storage_dir=None, keep_storage=False):
+        # if given, every field is backed by a memory-mapped file in storage_dir instead of RAM
+        self.storage_dir = storage_dir
+        self._storage_files = []
+        if storage_dir is not None:
+            assert str(device) == "cpu", "Memory-mapped replay storage must live on the cpu"
+            os.makedirs(storage_dir, exist_ok=True)
         super(ReplayBuffer, self).__init__(scheme, groups, buffer_size, max_seq_length, preprocess=preprocess, device=device)
+        # the files are deleted on close(), when the buffer is garbage collected or at interpreter exit
+        self._storage_cleanup = None
+        if storage_dir is not None and not keep_storage:
+            self._storage_cleanup = weakref.finalize(self, _remove_storage, storage_dir, self._storage_files)
         self.buffer_size = buffer_size  # same as self.batch_size but more explicit
         self.buffer_index = 0
         self.episodes_in_buffer = 0
+        # Stage GPU episodes through pinned host memory when the buffer itself lives on the CPU
+        self.pin_memory = pin_memory and str(device) == "cpu" and th.cuda.is_available()
+        self._staging = {}
+        # number of filled timesteps per slot, lets sample() truncate before indexing
+        self._ep_lengths = np.zeros(buffer_size, dtype=np.int64)
+        # reusable output tensors for sample() and the event guarding their last transfer
+        self._arena = {}
+        self._arena_event = None
+        # slots written since the last snapshot, and the snapshot directory they are relative to
+        self._dirty_slots = np.zeros(buffer_size, dtype=np.bool_)
+        self._snapshot_path = None
 
     def insert_episode_batch(self, ep_batch):
         if self.buffer_index + ep_batch.batch_size <= self.buffer_size:
-            self.update(ep_batch.data.transition_data,
-                        slice(self.buffer_index, self.buffer_index + ep_batch.batch_size),
-                        slice(0, ep_batch.max_seq_length),
-                        mark_filled=False)
-            self.update(ep_batch.data.episode_data,
-                        slice(self.buffer_index, self.buffer_index + ep_batch.batch_size))
+            self._insert(ep_batch,
+                         slice(self.buffer_index, self.buffer_index + ep_batch.batch_size),
+                         slice(0, ep_batch.max_seq_length))
             self.buffer_index = (self.buffer_index + ep_batch.batch_size)
             self.episodes_in_buffer = max(self.episodes_in_buffer, self.buffer_index)
             self.buffer_index = self.buffer_index % self.buffer_size
@@ -227,17 +339,266 @@ class ReplayBuffer(EpisodeBatch):
             self.insert_episode_batch(ep_batch[0:buffer_left, :])
             self.insert_episode_batch(ep_batch[buffer_left:, :])
 
+    def _alloc(self, field_key, shape, dtype, episode_const):
+        if self.storage_dir is None:
+            return super(ReplayBuffer, self)._alloc(field_key, shape, dtype, episode_const)
+        np_dtype = th.empty(0, dtype=dtype).numpy().dtype
+        path = os.path.join(self.storage_dir, "{}.dat".format(field_key))
+        self._storage_files.append(path)
+        mmap = np.memmap(path, dtype=np_dtype, mode="w+", shape=shape)
+        return th.from_numpy(mmap)
+
+    def close(self):
+        """
+        Deletes the memory-mapped storage files (unless keep_storage was set). The buffer stays
+        readable until it is dropped, the mapped files are only unlinked.
+        """
+        if self._storage_cleanup is not None:
+            self._storage_cleanup()
+
+    def _insert(self, ep_batch, bs, ts):
+        """
+        Bulk tensor-to-tensor copy of an episode batch into the buffer slots bs.
+        Unlike update(), incoming tensors are not re-wrapped and preprocessed keys
+        (e.g. actions_onehot) are only recomputed if the batch doesn't carry them.
+        """
+        copies = []
+        for k, v in ep_batch.data.transition_data.items():
+            if k not in self.data.transition_data:
+                raise KeyError("{} not found in transition data".format(k))
+            copies.append((self.data.transition_data[k][bs, ts], self._stage(k, self._to_storage(ep_batch, k, v))))
+        for k, v in ep_batch.data.episode_data.items():
+            if k not in self.data.episode_data:
+                raise KeyError("{} not found in episode data".format(k))
+            copies.append((self.data.episode_data[k][bs], self._stage(k, self._to_storage(ep_batch, k, v))))
+        if self.pin_memory and str(ep_batch.device) != "cpu":
+            # staging copies are asynchronous, wait for them before reading back
+            th.cuda.synchronize()
+        for dest, v in copies:
+            dest.copy_(v.view_as(dest))
+        self._ep_lengths[bs] = self.data.transition_data["filled"][bs].sum(1).view(-1).cpu().numpy()
+        self._dirty_slots[bs] = True
+
+        for k, (new_k, transforms) in self.preprocess.items():
+            if new_k in ep_batch.data.transition_data or new_k in ep_batch.data.episode_data:
+                continue
+            if k in self.data.transition_data:
+                target, slices = self.data.transition_data, (bs, ts)
+            else:
+                target, slices = self.data.episode_data, bs
+            v = target[k][slices]
+            for transform in transforms:
+                v = transform.transform(v)
+            target[new_k][slices] = v.view_as(target[new_k][slices])
+
+    def _to_storage(self, ep_batch, k, v):
+        # pack incoming fields that this buffer stores bit-packed but the episode batch doesn't
+        if k in self.packbits and k not in ep_batch.packbits:
+            return self.packbits[k].transform(v)
+        return v
+
+    def _stage(self, k, v):
+        if not self.pin_memory or v.device.type == "cpu":
+            return v
+        stage = self._staging.get(k)
+        if stage is None or stage.shape[1:] != v.shape[1:] or stage.shape[0] < v.shape[0]:
+            stage = th.empty(v.shape, dtype=v.dtype, pin_memory=True)
+            self._staging[k] = stage
+        stage = stage[:v.shape[0]]
+        stage.copy_(v, non_blocking=True)
+        return stage
+
     def can_sample(self, batch_size):
         return self.episodes_in_buffer >= batch_size
 
-    def sample(self, batch_size):
+    def sample(self, batch_size, device=None):
+        """
+        Returns an EpisodeBatchView truncated to the longest sampled episode, optionally
+        moved to device (asynchronously if the buffer is pinned).
+        """
         assert self.can_sample(batch_size)
         if self.episodes_in_buffer == batch_size:
-            return self[:batch_size]
+            ep_ids = np.arange(batch_size)
         else:
             # Uniform sampling only atm
             ep_ids = np.random.choice(self.episodes_in_buffer, batch_size, replace=False)
-            return self[ep_ids]
+        return self._gather(ep_ids, device=device)
+
+    def _storage_order(self, ep_ids):
+        return np.argsort(ep_ids)
+
+    def _sort_for_storage(self, ep_ids, weights):
+        # read memory-mapped episodes in storage order so disk access stays as sequential as possible
+        if self.storage_dir is None:
+            return ep_ids, weights
+        order = self._storage_order(ep_ids)
+        if weights is not None:
+            weights = weights[th.as_tensor(order, device=weights.device)]
+        return ep_ids[order], weights
+
+    def _gather(self, ep_ids, device=None, weights=None):
+        ep_ids, weights = self._sort_for_storage(ep_ids, weights)
+        bs = len(ep_ids)
+        max_t = max(int(self._ep_lengths[ep_ids].max()), 1)
+        idx = th.as_tensor(ep_ids, dtype=th.long, device=self.device)
+        self._wait_arena()
+
+        data = self._new_data_sn()
+        for k, v in self.data.transition_data.items():
+            out = self._arena_view(k, (bs, max_t), v.shape[2:], v.dtype)
+            th.index_select(v[:, :max_t], 0, idx, out=out)
+            data.transition_data[k] = out
+        for k, v in self.data.episode_data.items():
+            out = self._arena_view(k, (bs,), v.shape[1:], v.dtype)
+            th.index_select(v, 0, idx, out=out)
+            data.episode_data[k] = out
+        return self._make_view(data, bs, max_t, ep_ids, device, weights)
+
+    def _wait_arena(self):
+        if self._arena_event is not None:
+            # previous sample may still be in flight from the arena to the device
+            self._arena_event.synchronize()
+            self._arena_event = None
+
+    def _make_view(self, data, bs, max_t, ep_ids, device, weights):
+        batch = EpisodeBatchView(self.scheme, self.groups, bs, max_t, data, self.device,
+                                 ep_ids=ep_ids, weights=weights, packbits=self.packbits)
+        if device is not None and str(device) != str(self.device):
+            batch.to(device, non_blocking=self.pin_memory)
+            if self.pin_memory:
+                self._arena_event = th.cuda.Event()
+                self._arena_event.record()
+        return batch
+
+    def _arena_view(self, k, lead_shape, vshape, dtype):
+        # arena holds up to (batch_size, max_seq_length) entries per key, viewed to the requested size
+        numel = int(np.prod(lead_shape)) * int(np.prod(vshape))
+        arena = self._arena.get(k)
+        if arena is None or arena.numel() < numel:
+            # size for the full episode length so later, longer samples reuse the same storage
+            full_numel = numel // lead_shape[1] * self.max_seq_length if len(lead_shape) > 1 else numel
+            arena = th.empty(full_numel, dtype=dtype, device=self.device, pin_memory=self.pin_memory)
+            self._arena[k] = arena
+        return arena[:numel].view(*lead_shape, *vshape)
+
+    def save_snapshot(self, path, chunk_size=256, compress=False):
+        """
+        Writes the filled part of the buffer to path as chunks of chunk_size episodes.
+        Saving again to the same path only rewrites the chunks touched since the last save.
+        Uncompressed chunks are plain .npy files so load_snapshot can memory-map them.
+        """
+        os.makedirs(path, exist_ok=True)
+        meta_name = os.path.join(path, "meta.pkl")
+        incremental = False
+        if self._snapshot_path == os.path.abspath(path) and os.path.isfile(meta_name):
+            with open(meta_name, "rb") as f:
+                old_meta = pickle.load(f)
+            incremental = old_meta["chunk_size"] == chunk_size and old_meta["compress"] == compress
+
+        written = 0
+        sections = self._snapshot_sections(chunk_size)
+        for section, fields, dirty, extent, chunk_len, lengths in sections:
+            for c in range((extent + chunk_len - 1) // chunk_len):
+                lo, hi = c * chunk_len, min((c + 1) * chunk_len, extent)
+                if incremental and not dirty[lo:hi].any():
+                    continue
+                # dense transition chunks are trimmed to their longest episode
+                max_t = None if lengths is None else max(int(lengths[lo:hi].max()), 1)
+                arrays = {k: (v[lo:hi] if max_t is None else v[lo:hi, :max_t]).cpu().numpy()
+                          for k, v in fields.items()}
+                self._write_chunk(path, section, c, arrays, compress)
+                written += 1
+        for _, _, dirty, _, _, _ in sections:
+            dirty[:] = False
+
+        meta = {
+            "type": type(self).__name__,
+            "chunk_size": chunk_size,
+            "compress": compress,
+            "fields": self._snapshot_fields(),
+            "state": self._snapshot_state(),
+        }
+        with open(meta_name + ".tmp", "wb") as f:
+            pickle.dump(meta, f)
+        os.replace(meta_name + ".tmp", meta_name)
+        self._snapshot_path = os.path.abspath(path)
+        return written
+
+    def load_snapshot(self, path):
+        """
+        Restores a snapshot written by save_snapshot into this (empty) buffer, which must
+        have the same type, size and scheme. Chunks are read through memory maps.
+        """
+        with open(os.path.join(path, "meta.pkl"), "rb") as f:
+            meta = pickle.load(f)
+        assert meta["type"] == type(self).__name__, \
+            "Snapshot of a {} can't be loaded into a {}".format(meta["type"], type(self).__name__)
+        assert meta["fields"] == self._snapshot_fields(), "Snapshot does not match the buffer scheme"
+        self._load_snapshot_state(meta["state"])
+
+        sections = self._snapshot_sections(meta["chunk_size"])
+        for section, fields, dirty, extent, chunk_len, lengths in sections:
+            for c in range((extent + chunk_len - 1) // chunk_len):
+                lo = c * chunk_len
+                arrays = self._read_chunk(path, section, c, meta["compress"], fields.keys())
+                for k, v in fields.items():
+                    arr = th.from_numpy(arrays[k])
+                    dest = v[lo:lo + arr.shape[0]]
+                    if lengths is not None:
+                        dest[:, arr.shape[1]:] = 0
+                        dest = dest[:, :arr.shape[1]]
+                    dest.copy_(arr)
+        for _, _, dirty, _, _, _ in sections:
+            dirty[:] = False
+        self._snapshot_path = os.path.abspath(path)
+
+    def _snapshot_sections(self, chunk_size):
+        # (name, fields, dirty rows, rows in use, rows per chunk, per-row lengths to trim time by)
+        extent = self._slot_extent()
+        return [("transition", self.data.transition_data, self._dirty_slots, extent, chunk_size, self._ep_lengths),
+                ("episode", self.data.episode_data, self._dirty_slots, extent, chunk_size, None)]
+
+    def _slot_extent(self):
+        written = np.flatnonzero(self._ep_lengths)
+        return int(written[-1]) + 1 if len(written) else 0
+
+    def _snapshot_fields(self):
+        return {k: (tuple(v.shape), str(v.dtype)) for k, v in
+                list(self.data.transition_data.items()) + list(self.data.episode_data.items())}
+
+    def _snapshot_state(self):
+        return {"buffer_index": self.buffer_index,
+                "episodes_in_buffer": self.episodes_in_buffer,
+                "ep_lengths": self._ep_lengths.copy()}
+
+    def _load_snapshot_state(self, state):
+        self.buffer_index = state["buffer_index"]
+        self.episodes_in_buffer = state["episodes_in_buffer"]
+        self._ep_lengths[:] = state["ep_lengths"]
+
+    @staticmethod
+    def _write_chunk(path, section, c, arrays, compress):
+        # write to a temporary name first so an interrupted save never leaves a torn chunk
+        if compress:
+            name = os.path.join(path, "{}_{:05d}.npz".format(section, c))
+            with open(name + ".tmp", "wb") as f:
+                np.savez_compressed(f, **arrays)
+            os.replace(name + ".tmp", name)
+            return
+        for k, arr in arrays.items():
+            name = os.path.join(path, "{}_{:05d}_{}.npy".format(section, c, k))
+            with open(name + ".tmp", "wb") as f:
+                np.save(f, arr)
+            os.replace(name + ".tmp", name)
+
+    @staticmethod
+    def _read_chunk(path, section, c, compress, keys):
+        if compress:
+            with np.load(os.path.join(path, "{}_{:05d}.npz".format(section, c))) as f:
+                return {k: f[k] for k in keys}
+        # copy-on-write maps are writable, so torch can wrap them without a copy
+        return {k: np.load(os.path.join(path, "{}_{:05d}_{}.npy".format(section, c, k)), mmap_mode="c")
+                for k in keys}
 
     def __repr__(self):
         return "ReplayBuffer. {}/{} episodes. Keys:{} Groups:{}".format(self.episodes_in_buffer,
@@ -257,6 +618,223 @@ class ReplayBuffer(EpisodeBatch):
     #     else:
     #         return (0 < slice.stop <= max_size) and (0 <= slice.start < max_size)
 
+class PackedReplayBuffer(ReplayBuffer):
+    """
+    Replay buffer that stores only the filled timesteps of each episode.
+    Transition fields live in one flat ring of transition_capacity steps, with per-slot
+    start offsets and lengths; episode fields keep one row per slot. Episodes are evicted
+    oldest first, either when their slot is reused or their transitions are overwritten.
+    Samples are re-padded only up to the longest sampled episode.
+    """
+    def __init__(self, scheme, groups, buffer_size, max_seq_length, transition_capacity,
+                 preprocess=None, device="cpu", pin_memory=False, storage_dir=None, keep_storage=False):
+        self.transition_capacity = transition_capacity
+        super(PackedReplayBuffer, self).__init__(scheme, groups, buffer_size, max_seq_length,
+                                                 preprocess=preprocess, device=device, pin_memory=pin_memory,
+                                                 storage_dir=storage_dir, keep_storage=keep_storage)
+        self.transition_index = 0
+        self._ep_start = np.zeros(buffer_size, dtype=np.int64)
+        self._ep_valid = np.zeros(buffer_size, dtype=np.bool_)
+        self._dirty_rows = np.zeros(transition_capacity, dtype=np.bool_)
+
+    def _alloc(self, field_key, shape, dtype, episode_const):
+        if not episode_const:
+            # (buffer_size, max_seq_length, ...) -> (transition_capacity, ...)
+            shape = (self.transition_capacity, *shape[2:])
+        return super(PackedReplayBuffer, self)._alloc(field_key, shape, dtype, episode_const)
+
+    def insert_episode_batch(self, ep_batch):
+        bs = ep_batch.batch_size
+        filled = ep_batch["filled"].reshape(bs, ep_batch.max_seq_length).bool()
+        lengths = filled.sum(1).cpu().numpy()
+        assert lengths.sum() <= self.transition_capacity, "Episode batch does not fit in transition_capacity"
+
+        assert bs <= self.buffer_size, "Episode batch does not fit in buffer_size"
+
+        # lay the batch out back to back in one contiguous block, wrapping to the start first
+        # if the room left at the end can't hold all of it, so its episodes never overlap
+        if self.transition_index + lengths.sum() > self.transition_capacity:
+            self.transition_index = 0
+        block_start = self.transition_index
+        starts = block_start + np.cumsum(lengths) - lengths
+        self.transition_index += int(lengths.sum())
+        slots = (self.buffer_index + np.arange(bs)) % self.buffer_size
+
+        # evict reused slots and any episode whose transitions are about to be overwritten
+        self._ep_valid[slots] = False
+        old_end = self._ep_start + self._ep_lengths
+        self._ep_valid &= ~((self._ep_start < self.transition_index) & (old_end > block_start))
+
+        rows = np.concatenate([np.arange(start, start + ep_len) for start, ep_len in zip(starts, lengths)])
+        self._dirty_rows[rows] = True
+        self._dirty_slots[slots] = True
+        rows = th.as_tensor(rows, dtype=th.long, device=self.device)
+        slots_t = th.as_tensor(slots, dtype=th.long, device=self.device)
+
+        copies = []
+        for k, v in ep_batch.data.transition_data.items():
+            if k not in self.data.transition_data:
+                raise KeyError("{} not found in transition data".format(k))
+            copies.append((self.data.transition_data[k], rows, self._stage(k, self._to_storage(ep_batch, k, v[filled]))))
+        for k, v in ep_batch.data.episode_data.items():
+            if k not in self.data.episode_data:
+                raise KeyError("{} not found in episode data".format(k))
+            copies.append((self.data.episode_data[k], slots_t, self._stage(k, self._to_storage(ep_batch, k, v))))
+        if self.pin_memory and str(ep_batch.device) != "cpu":
+            # staging copies are asynchronous, wait for them before reading back
+            th.cuda.synchronize()
+        for dest, idx, v in copies:
+            dest.index_copy_(0, idx, v.to(dtype=dest.dtype, device=dest.device).view(-1, *dest.shape[1:]))
+
+        for k, (new_k, transforms) in self.preprocess.items():
+            if new_k in ep_batch.data.transition_data or new_k in ep_batch.data.episode_data:
+                continue
+            if k in self.data.transition_data:
+                target, idx = self.data.transition_data, rows
+            else:
+                target, idx = self.data.episode_data, slots_t
+            v = target[k][idx]
+            for transform in transforms:
+                v = transform.transform(v)
+            target[new_k].index_copy_(0, idx, v.to(target[new_k].dtype).view(-1, *target[new_k].shape[1:]))
+
+        self._ep_start[slots] = starts
+        self._ep_lengths[slots] = lengths
+        self._ep_valid[slots] = True
+        self.buffer_index = (self.buffer_index + bs) % self.buffer_size
+        self.episodes_in_buffer = int(self._ep_valid.sum())
+
+    def sample(self, batch_size, device=None):
+        assert self.can_sample(batch_size)
+        # Uniform sampling only atm
+        ep_ids = np.random.choice(np.flatnonzero(self._ep_valid), batch_size, replace=False)
+        return self._gather(ep_ids, device=device)
+
+    def _storage_order(self, ep_ids):
+        return np.argsort(self._ep_start[ep_ids])
+
+    def _gather(self, ep_ids, device=None, weights=None):
+        ep_ids, weights = self._sort_for_storage(ep_ids, weights)
+        bs = len(ep_ids)
+        lengths = self._ep_lengths[ep_ids]
+        max_t = max(int(lengths.max()), 1)
+        t_range = np.arange(max_t)
+        valid = t_range[None] < lengths[:, None]
+        # padded timesteps read the episode's first row and are zeroed after the gather
+        rows = self._ep_start[ep_ids][:, None] + np.where(valid, t_range[None], 0)
+        rows = th.as_tensor(rows.reshape(-1), dtype=th.long, device=self.device)
+        pad = th.as_tensor(~valid, device=self.device)
+        self._wait_arena()
+
+        data = self._new_data_sn()
+        for k, v in self.data.transition_data.items():
+            vshape = v.shape[1:]
+            out = self._arena_view(k, (bs, max_t), vshape, v.dtype)
+            th.index_select(v, 0, rows, out=out.view(bs * max_t, *vshape))
+            out.masked_fill_(pad.view(bs, max_t, *([1] * len(vshape))), 0)
+            data.transition_data[k] = out
+        idx = th.as_tensor(ep_ids, dtype=th.long, device=self.device)
+        for k, v in self.data.episode_data.items():
+            out = self._arena_view(k, (bs,), v.shape[1:], v.dtype)
+            th.index_select(v, 0, idx, out=out)
+            data.episode_data[k] = out
+        return self._make_view(data, bs, max_t, ep_ids, device, weights)
+
+    def _snapshot_sections(self, chunk_size):
+        # transition rows are chunked by chunk_size episodes' worth of timesteps
+        row_extent = int((self._ep_start + self._ep_lengths).max())
+        return [("transition", self.data.transition_data, self._dirty_rows, row_extent,
+                 chunk_size * self.max_seq_length, None),
+                ("episode", self.data.episode_data, self._dirty_slots, self._slot_extent(), chunk_size, None)]
+
+    def _snapshot_state(self):
+        state = super(PackedReplayBuffer, self)._snapshot_state()
+        state.update({"transition_index": self.transition_index,
+                      "ep_start": self._ep_start.copy(),
+                      "ep_valid": self._ep_valid.copy()})
+        return state
+
+    def _load_snapshot_state(self, state):
+        super(PackedReplayBuffer, self)._load_snapshot_state(state)
+        self.transition_index = state["transition_index"]
+        self._ep_start[:] = state["ep_start"]
+        self._ep_valid[:] = state["ep_valid"]
+
+    def __repr__(self):
+        return "PackedReplayBuffer. {}/{} episodes, {} transitions. Keys:{} Groups:{}".format(
+            self.episodes_in_buffer, self.buffer_size, self.transition_capacity,
+            self.scheme.keys(), self.groups.keys())
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    """
+    Proportional prioritized replay (Schaul et al. 2016) over whole episodes.
+    Priorities live in a sum tree (sampling) and a min tree (max importance weight),
+    both O(log N) per update. New episodes get the max priority seen so far.
+    """
+    def __init__(self, scheme, groups, buffer_size, max_seq_length, alpha, beta, t_max, eps=1e-6,
+                 preprocess=None, device="cpu", pin_memory=False, storage_dir=None, keep_storage=False):
+        super(PrioritizedReplayBuffer, self).__init__(scheme, groups, buffer_size, max_seq_length,
+                                                      preprocess=preprocess, device=device, pin_memory=pin_memory,
+                                                      storage_dir=storage_dir, keep_storage=keep_storage)
+        self.alpha = alpha
+        self.beta_start = beta
+        self.t_max = t_max
+        self.eps = eps
+        self.max_priority = 1.0
+        self.sum_tree = SumTree(buffer_size)
+        self.min_tree = MinTree(buffer_size)
+
+    def _insert(self, ep_batch, bs, ts):
+        super(PrioritizedReplayBuffer, self)._insert(ep_batch, bs, ts)
+        ids = np.arange(bs.start, bs.stop)
+        self.sum_tree.update(ids, self.max_priority ** self.alpha)
+        self.min_tree.update(ids, self.max_priority ** self.alpha)
+
+    def sample(self, batch_size, t_env=0, device=None):
+        assert self.can_sample(batch_size)
+        # anneal the importance sampling exponent towards 1 over training
+        beta = self.beta_start + (1.0 - self.beta_start) * min(1.0, t_env / self.t_max)
+
+        # stratified: one draw from each of batch_size equal segments of the total priority
+        total = self.sum_tree.reduce()
+        segment = total / batch_size
+        prefixsums = (np.arange(batch_size) + np.random.rand(batch_size)) * segment
+        ep_ids = self.sum_tree.find_prefixsum_idx(prefixsums)
+        ep_ids = np.minimum(ep_ids, self.episodes_in_buffer - 1)
+
+        probs = self.sum_tree[ep_ids] / total
+        min_prob = self.min_tree.reduce() / total
+        max_weight = (min_prob * self.episodes_in_buffer) ** (-beta)
+        weights = (probs * self.episodes_in_buffer) ** (-beta) / max_weight
+        weights = th.as_tensor(weights, dtype=th.float32, device=self.device)
+        return self._gather(ep_ids, device=device, weights=weights)
+
+    def update_priorities(self, ep_ids, priorities):
+        priorities = np.abs(np.asarray(priorities, dtype=np.float64)) + self.eps
+        self.sum_tree.update(ep_ids, priorities ** self.alpha)
+        self.min_tree.update(ep_ids, priorities ** self.alpha)
+        self.max_priority = max(self.max_priority, priorities.max())
+
+    def _snapshot_state(self):
+        state = super(PrioritizedReplayBuffer, self)._snapshot_state()
+        state.update({"max_priority": self.max_priority,
+                      "sum_tree": self.sum_tree.tree.copy(),
+                      "min_tree": self.min_tree.tree.copy()})
+        return state
+
+    def _load_snapshot_state(self, state):
+        super(PrioritizedReplayBuffer, self)._load_snapshot_state(state)
+        self.max_priority = state["max_priority"]
+        self.sum_tree.tree[:] = state["sum_tree"]
+        self.min_tree.tree[:] = state["min_tree"]
+
+    def __repr__(self):
+        return "PrioritizedReplayBuffer. {}/{} episodes. Keys:{} Groups:{}".format(self.episodes_in_buffer,
+                                                                                   self.buffer_size,
+                                                                                   self.scheme.keys(),
+                                                                                   self.groups.keys())
+
+
 if __name__ == "__main__":
     bs = 4
     n_agents = 2
@@ -269,7 +847,7 @@ if __name__ == "__main__":
         "state": {"vshape": (3,3)},
         "epsilon": {"vshape": (1,), "episode_const": True}
     }
-    from transforms import OneHot
+    from components.transforms import OneHot
     preprocess = {
         "actions": ("actions_onehot", [OneHot(out_dim=5)])
     }
@@ -0,0 +1,58 @@
+import numpy as np
+
+
+class SegmentTree:
+    """
+    Array-based binary segment tree over a fixed number of leaves.
+    Node i has children 2i and 2i+1, leaves live at [capacity, 2 * capacity).
+    Updates take a batch of leaf indices and refresh their ancestors one level at a time.
+    """
+    def __init__(self, capacity, operation, neutral_element):
+        assert capacity > 0, "Capacity must be positive"
+        self.capacity = 1
+        while self.capacity < capacity:
+            self.capacity *= 2
+        self.operation = operation
+        self.neutral_element = neutral_element
+        self.tree = np.full(2 * self.capacity, neutral_element, dtype=np.float64)
+
+    def update(self, idxs, values):
+        idxs = np.asarray(idxs, dtype=np.int64) + self.capacity
+        self.tree[idxs] = values
+        idxs = np.unique(idxs // 2)
+        while idxs[0] >= 1:
+            self.tree[idxs] = self.operation(self.tree[2 * idxs], self.tree[2 * idxs + 1])
+            if idxs[0] == 1:
+                break
+            idxs = np.unique(idxs // 2)
+
+    def reduce(self):
+        return self.tree[1]
+
+    def __getitem__(self, idxs):
+        return self.tree[np.asarray(idxs, dtype=np.int64) + self.capacity]
+
+
+class SumTree(SegmentTree):
+    def __init__(self, capacity):
+        super(SumTree, self).__init__(capacity, np.add, 0.0)
+
+    def find_prefixsum_idx(self, prefixsums):
+        """
+        For each value v finds the highest leaf i such that sum(leaves[:i]) <= v.
+        Descends all values in lockstep, O(log N) per value.
+        """
+        prefixsums = np.array(prefixsums, dtype=np.float64)
+        idxs = np.ones(len(prefixsums), dtype=np.int64)
+        while idxs[0] < self.capacity:
+            left = 2 * idxs
+            left_sum = self.tree[left]
+            go_right = prefixsums >= left_sum
+            prefixsums = np.where(go_right, prefixsums - left_sum, prefixsums)
+            idxs = np.where(go_right, left + 1, left)
+        return idxs - self.capacity
+
+
+class MinTree(SegmentTree):
+    def __init__(self, capacity):
+        super(MinTree, self).__init__(capacity, np.minimum, float('inf'))
@@ -20,4 +20,34 @@ class OneHot(Transform):
     def infer_output_info(self, vshape_in, dtype_in):
         # TODO: Check this shouldn't be here
         # assert vshape_in == (1,)
-        return (self.out_dim,), th.float32
\ No newline at end of file
+        return (self.out_dim,), th.float32
+
+class PackBits(Transform):
+    """
+    Packs the last dimension of a 0/1 tensor into uint8 bytes, 8 flags per byte
+    (most significant bit first, as np.packbits). inverse_transform unpacks back to out_dtype.
+    """
+    def __init__(self, n_bits, out_dtype):
+        self.n_bits = n_bits
+        self.n_bytes = (n_bits + 7) // 8
+        self.out_dtype = out_dtype
+
+    def transform(self, tensor):
+        bits = (tensor != 0).to(th.uint8)
+        pad = self.n_bytes * 8 - self.n_bits
+        if pad > 0:
+            bits = th.cat([bits, bits.new_zeros(*bits.shape[:-1], pad)], dim=-1)
+        bits = bits.reshape(*bits.shape[:-1], self.n_bytes, 8)
+        return (bits << self._shifts(bits.device)).sum(-1, dtype=th.uint8)
+
+    def inverse_transform(self, tensor):
+        bits = (tensor.unsqueeze(-1) >> self._shifts(tensor.device)) & 1
+        bits = bits.reshape(*tensor.shape[:-1], self.n_bytes * 8)[..., :self.n_bits]
+        return bits.to(self.out_dtype)
+
+    def infer_output_info(self, vshape_in, dtype_in):
+        return (*vshape_in[:-1], self.n_bytes), th.uint8
+
+    @staticmethod
+    def _shifts(device):
+        return th.arange(7, -1, -1, dtype=th.uint8, device=device)
@@ -1,5 +1,7 @@
 from modules.agents import REGISTRY as agent_REGISTRY
 from components.action_selectors import REGISTRY as action_REGISTRY
+from components.episode_buffer import EpisodeBatch
+from types import SimpleNamespace as SN
 import torch as th
 
 
@@ -25,6 +27,35 @@ class BasicMAC:
             return chosen_actions, agent_outputs[bs]
         return chosen_actions
 
+    def select_actions_subset(self, ep_batch, t_eps, t_env, bs, test_mode=False):
+        """
+        Selects actions for the batch elements in bs, each at its own timestep t_eps[i],
+        and only advances their hidden states. Used when envs step asynchronously.
+        """
+        sub_batch = self._time_slice(ep_batch, t_eps, bs)
+        idx = th.as_tensor(bs, dtype=th.long, device=self.hidden_states.device)
+        hidden_states = self.hidden_states.reshape(ep_batch.batch_size, -1)
+        self.hidden_states = hidden_states[idx]
+        agent_outputs = self.forward(sub_batch, 1, test_mode=test_mode)
+        self.hidden_states = hidden_states.index_copy(
+            0, idx, self.hidden_states.reshape(len(bs), -1)).view(ep_batch.batch_size, self.n_agents, -1)
+        avail_actions = sub_batch["avail_actions"][:, 1]
+        return self.action_selector.select_action(agent_outputs, avail_actions, t_env, test_mode=test_mode)
+
+    def _time_slice(self, ep_batch, t_eps, bs):
+        # two-step batch holding [t - 1, t] of each env, so inputs that look at the previous step still work
+        bs = th.as_tensor(bs, dtype=th.long, device=ep_batch.device)
+        t = th.as_tensor(t_eps, dtype=th.long, device=ep_batch.device)
+        first = (t == 0)
+        data = SN(transition_data={}, episode_data={})
+        for k, v in ep_batch.data.transition_data.items():
+            prev = v[bs, (t - 1).clamp(min=0)]
+            prev = prev.masked_fill(first.view(-1, *([1] * (prev.dim() - 1))), 0)
+            data.transition_data[k] = th.stack([prev, v[bs, t]], dim=1)
+        for k, v in ep_batch.data.episode_data.items():
+            data.episode_data[k] = v[bs]
+        return EpisodeBatch(ep_batch.scheme, ep_batch.groups, len(t_eps), 2, data=data, device=ep_batch.device)
+
     def forward(self, ep_batch, t, test_mode=False, **kwargs):
         if t is None:
             t = slice(0, ep_batch["avail_actions"].shape[1])
@@ -39,7 +70,15 @@ class BasicMAC:
             agent_outs, self.hidden_states, groups = self.agent(agent_inputs, self.hidden_states, **kwargs)
         else:
             agent_outs, self.hidden_states = self.agent(agent_inputs, self.hidden_states)
+        agent_outs = self._process_outputs(agent_outs, avail_actions, test_mode)
 
+        if int_t:
+            return agent_outs.squeeze(1)
+        if kwargs.get('imagine', False) or kwargs.get('drop', False):
+            return agent_outs, groups
+        return agent_outs
+
+    def _process_outputs(self, agent_outs, avail_actions, test_mode):
         if self.agent_output_type == "pi_logits":
 
             if getattr(self.args, "mask_before_softmax", True):
@@ -60,10 +99,6 @@ class BasicMAC:
                 if getattr(self.args, "mask_before_softmax", True):
                     # Zero out the unavailable actions
                     agent_outs[avail_actions == 0] = 0.0
-        if int_t:
-            return agent_outs.squeeze(1)
-        if kwargs.get('imagine', False) or kwargs.get('drop', False):
-            return agent_outs, groups
         return agent_outs
 
     def init_hidden(self, batch_size):
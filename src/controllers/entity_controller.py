@@ -1,12 +1,95 @@
 from .basic_controller import BasicMAC
+import numpy as np
 import torch as th
 
+# th.inference_mode needs torch >= 1.9
+inference_mode = getattr(th, "inference_mode", th.no_grad)
+
 
 # This multi-agent controller shares parameters between agents and takes
 # entities + observation masks as input
 class EntityMAC(BasicMAC):
     def __init__(self, scheme, groups, args):
         super(EntityMAC, self).__init__(scheme, groups, args)
+        self.entity_shape = scheme["entities"]["vshape"]
+        # streamed inputs are stored like the episode batch stores them
+        self._stream_scheme = {}
+        for k, v in scheme.items():
+            vshape = (v["vshape"],) if isinstance(v["vshape"], int) else tuple(v["vshape"])
+            shape = ((groups[v["group"]],) if "group" in v else ()) + vshape
+            self._stream_scheme[k] = (shape, v.get("dtype", th.float32))
+        self._stream_bufs = None
+        self._last_actions = None
+
+    def init_hidden(self, batch_size):
+        super(EntityMAC, self).init_hidden(batch_size)
+        # streaming state starts over with the hidden states
+        self._stream_bufs = None
+        self._last_actions = None
+
+    def select_actions_stream(self, step_data, t_env, bs=slice(None), test_mode=False):
+        """
+        Rollout counterpart of select_actions that takes only the current step of the envs in bs,
+        so nothing is read back from the episode batch.
+        step_data: "entities", "obs_mask", "entity_mask", "avail_actions" (and "gt_mask" if available)
+                   of the envs in bs, as tensors or arrays (e.g. a runner's pre_transition_data)
+        Hidden states and the last actions of every env are kept in the MAC, init_hidden resets them.
+        """
+        keys = ["entities", "obs_mask", "entity_mask", "avail_actions"]
+        if self.args.gt_mask_avail:
+            keys.append("gt_mask")
+        with inference_mode():
+            if self._stream_bufs is None:
+                self._init_stream(keys)
+            if isinstance(bs, slice):
+                n = self.hidden_states.shape[0]
+                idx = bs
+            else:
+                n = len(bs)
+                idx = th.as_tensor(bs, dtype=th.long, device=self.hidden_states.device)
+            # copy the step into the preallocated buffers, (n, 1, ...) like a one-step batch
+            step = {}
+            for k in keys:
+                step[k] = self._stream_bufs[k][:n]
+                if k not in step_data:
+                    continue  # e.g. gt_mask the runner does not send, stays zero as in the batch
+                v = step_data[k]
+                v = v if isinstance(v, th.Tensor) else th.as_tensor(np.asarray(v))
+                step[k].copy_(v.reshape(step[k].shape))
+            entities = step["entities"]
+            if self.args.entity_last_action:
+                entities = self._stream_bufs["inputs"][:n]
+                entities[:, :, :, :self.entity_shape] = step["entities"]
+                entities[:, 0, :self.n_agents, self.entity_shape:] = self._last_actions[idx]
+            agent_inputs = (entities,) + tuple(step[k] for k in keys[1:] if k != "avail_actions")
+            avail_actions = step["avail_actions"]
+
+            agent_outs, hidden_states = self.agent(agent_inputs, self.hidden_states[idx])
+            if isinstance(idx, slice):
+                self.hidden_states = hidden_states.view(n, self.n_agents, -1)
+            else:
+                self.hidden_states[idx] = hidden_states.view(n, self.n_agents, -1)
+            agent_outs = self._process_outputs(agent_outs, avail_actions, test_mode)
+            chosen_actions = self.action_selector.select_action(agent_outs[:, 0], avail_actions[:, 0], t_env,
+                                                                test_mode=test_mode)
+            if self.args.entity_last_action:
+                last_actions = th.zeros_like(self._last_actions[:n])
+                self._last_actions[idx] = last_actions.scatter_(2, chosen_actions.unsqueeze(2), 1)
+        return chosen_actions
+
+    def _init_stream(self, keys):
+        batch_size = self.hidden_states.shape[0]
+        device = self.hidden_states.device
+        # own the hidden states, init_hidden leaves an expanded view
+        self.hidden_states = self.hidden_states.clone()
+        self._stream_bufs = {}
+        for k in keys:
+            shape, dtype = self._stream_scheme[k]
+            self._stream_bufs[k] = th.zeros(batch_size, 1, *shape, dtype=dtype, device=device)
+        if self.args.entity_last_action:
+            self._stream_bufs["inputs"] = th.zeros(batch_size, 1, self.args.n_entities,
+                                                   self.entity_shape + self.args.n_actions, device=device)
+            self._last_actions = th.zeros(batch_size, self.n_agents, self.args.n_actions, device=device)
 
     def _build_inputs(self, batch, t):
         # Assumes homogenous agents with entity + observation mask inputs.
@@ -25,9 +108,12 @@ class EntityMAC(BasicMAC):
                     batch["actions_onehot"][:, slice(t.start - 1, t.stop - 1)])
             entities.append(ent_acs)
         entities = th.cat(entities, dim=3)
+        # sampled training batches carry bool masks shared with the learner's other forwards
+        masks = getattr(batch, "masks", None)
+        obs_mask = batch["obs_mask"][:, t] if masks is None else masks.obs[:, t]
         if self.args.gt_mask_avail:
-            return (entities, batch["obs_mask"][:, t], batch["entity_mask"][:, t], batch["gt_mask"][:, t])
-        return (entities, batch["obs_mask"][:, t], batch["entity_mask"][:, t])
+            return (entities, obs_mask, batch["entity_mask"][:, t], batch["gt_mask"][:, t])
+        return (entities, obs_mask, batch["entity_mask"][:, t])
 
     def _get_input_shape(self, scheme):
         input_shape = scheme["entities"]["vshape"]
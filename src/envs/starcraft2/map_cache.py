@@ -0,0 +1,67 @@
+import os
+import pickle
+
+import numpy as np
+
+ARRAYS = ("pathing_grid", "terrain_height")
+
+
+def decode_map_info(map_info):
+    """
+    Decodes the StartRaw map info of a game into a dict with the playable area size,
+    map size, pathing_grid (map_x, map_y) bool and terrain_height (map_x, map_y) in [0, 1].
+    """
+    map_play_area_min = map_info.playable_area.p0
+    map_play_area_max = map_info.playable_area.p1
+    map_x = map_info.map_size.x
+    map_y = map_info.map_size.y
+
+    grid = np.frombuffer(map_info.pathing_grid.data, dtype=np.uint8)
+    if map_info.pathing_grid.bits_per_pixel == 1:
+        # 8 cells per byte, most significant bit first
+        pathing_grid = np.unpackbits(grid.reshape(map_x, map_y // 8), axis=1).T.astype(np.bool_)
+    else:
+        pathing_grid = np.invert(np.flip(grid.reshape(map_x, map_y).T.astype(np.bool_), axis=1))
+
+    terrain_height = np.flip(
+        np.frombuffer(map_info.terrain_height.data, dtype=np.uint8).reshape(map_x, map_y).T, 1) / 255
+
+    return {"max_distance_x": map_play_area_max.x - map_play_area_min.x,
+            "max_distance_y": map_play_area_max.y - map_play_area_min.y,
+            "map_x": map_x,
+            "map_y": map_y,
+            "pathing_grid": np.ascontiguousarray(pathing_grid),
+            "terrain_height": np.ascontiguousarray(terrain_height)}
+
+
+def cache_path(cache_dir, map_name, game_version):
+    return os.path.join(cache_dir, "{}_{}".format(map_name, game_version or "latest"))
+
+
+def load_map_info(path):
+    """Loads a cached decode_map_info dict, arrays memory-mapped read-only. None if not cached."""
+    meta_path = os.path.join(path, "meta.pkl")
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, "rb") as f:
+        info = pickle.load(f)
+    for name in ARRAYS:
+        info[name] = np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+    return info
+
+
+def save_map_info(path, info):
+    """
+    Writes a decode_map_info dict under path. Every file is written to a temporary
+    name and renamed, meta.pkl last, so concurrent workers never read a partial cache.
+    """
+    os.makedirs(path, exist_ok=True)
+    suffix = ".tmp{}".format(os.getpid())
+    for name in ARRAYS:
+        tmp = os.path.join(path, name + suffix + ".npy")
+        np.save(tmp, info[name])
+        os.replace(tmp, os.path.join(path, name + ".npy"))
+    tmp = os.path.join(path, "meta.pkl" + suffix)
+    with open(tmp, "wb") as f:
+        pickle.dump({k: v for k, v in info.items() if k not in ARRAYS}, f)
+    os.replace(tmp, os.path.join(path, "meta.pkl"))
@@ -0,0 +1,119 @@
+import threading
+import time
+
+from absl import logging
+from pysc2.lib import protocol
+
+
+class SC2ProcessPool:
+    """
+    Keeps n_spares StarCraft II instances launched and joined to a game, so a crashed
+    instance can be replaced without waiting for a launch.
+    A background thread relaunches spares as they are taken and pings the idle ones
+    every ping_interval seconds, dropping any that stopped responding.
+    launch_fn starts one instance and returns its (process, controller). After
+    max_launch_failures launches fail in a row, a take() with no spare left re-raises the
+    last launch error instead of waiting forever.
+    """
+    def __init__(self, launch_fn, n_spares=1, ping_interval=30.0, max_launch_failures=3, retry_delay=1.0):
+        assert n_spares > 0, "Pool needs at least one spare"
+        self._launch_fn = launch_fn
+        self.n_spares = n_spares
+        self.ping_interval = ping_interval
+        self.max_launch_failures = max_launch_failures
+        self.retry_delay = retry_delay
+        self._spares = []
+        self._cond = threading.Condition()
+        self._closed = False
+        self._launch_error = None
+        self.stats = {"swaps": 0, "launch_failures": 0, "ping_failures": 0}
+        self._thread = threading.Thread(target=self._maintain, daemon=True)
+        self._thread.start()
+
+    def take(self):
+        """Returns a ready (process, controller), waiting for a launch if no spare is left."""
+        with self._cond:
+            while not self._spares:
+                assert not self._closed, "Pool is closed"
+                if self._launch_error is not None:
+                    # hand the error to this caller, the pool keeps trying in the background
+                    error, self._launch_error = self._launch_error, None
+                    raise error
+                self._cond.wait()
+            spare = self._spares.pop(0)
+            self._cond.notify_all()
+        return spare
+
+    def swap(self, broken_proc):
+        """Closes broken_proc in the background and returns a spare in its place."""
+        self.stats["swaps"] += 1
+        threading.Thread(target=self._close_proc, args=(broken_proc,), daemon=True).start()
+        return self.take()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            spares, self._spares = self._spares, []
+            self._cond.notify_all()
+        for proc, _ in spares:
+            self._close_proc(proc)
+
+    def _maintain(self):
+        next_ping = time.time() + self.ping_interval
+        failures = 0
+        while True:
+            with self._cond:
+                while (not self._closed and len(self._spares) >= self.n_spares and
+                       time.time() < next_ping):
+                    self._cond.wait(timeout=max(next_ping - time.time(), 0))
+                if self._closed:
+                    return
+                launch = len(self._spares) < self.n_spares
+            if launch:
+                try:
+                    spare = self._launch_fn()
+                except Exception as e:
+                    self.stats["launch_failures"] += 1
+                    failures += 1
+                    logging.warning("Failed to launch a spare SC2 instance: {}".format(e))
+                    if failures >= self.max_launch_failures:
+                        failures = 0
+                        with self._cond:
+                            self._launch_error = e
+                            self._cond.notify_all()
+                    time.sleep(self.retry_delay)
+                    continue
+                failures = 0
+                with self._cond:
+                    if self._closed:
+                        self._close_proc(spare[0])
+                        return
+                    self._launch_error = None
+                    self._spares.append(spare)
+                    self._cond.notify_all()
+            else:
+                self._ping_spares()
+                next_ping = time.time() + self.ping_interval
+
+    def _ping_spares(self):
+        with self._cond:
+            spares = list(self._spares)
+        for spare in spares:
+            proc, controller = spare
+            try:
+                controller.ping()
+            except (protocol.ProtocolError, protocol.ConnectionError):
+                self.stats["ping_failures"] += 1
+                with self._cond:
+                    if spare not in self._spares:
+                        continue  # taken meanwhile, its user will find out
+                    self._spares.remove(spare)
+                    self._cond.notify_all()
+                self._close_proc(proc)
+
+    @staticmethod
+    def _close_proc(proc):
+        try:
+            proc.close()
+        except Exception as e:
+            logging.warning("Failed to close SC2 instance: {}".format(e))
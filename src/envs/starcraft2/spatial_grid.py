@@ -0,0 +1,83 @@
+import numpy as np
+
+
+class SpatialGrid:
+    """
+    Uniform grid over unit positions for fixed-radius neighbour queries.
+    Units are bucketed into square cells of side cell_size (at least the largest query
+    radius), so every pair within range lies in the same or an adjacent cell. Cells are
+    looked up with a sorted key array, which keeps construction and queries near-linear
+    in the number of units instead of quadratic.
+    """
+    # the 3x3 block of cells around (and including) a unit's own cell
+    OFFSETS = np.array([(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)])
+
+    def __init__(self, pos, cell_size, active=None):
+        """
+        pos: (n_units, 2) positions
+        active: optional (n_units,) bool, inactive units are left out of the grid
+        """
+        self.pos = pos
+        self.cell_size = float(cell_size)
+        self.idxs = np.arange(len(pos)) if active is None else np.flatnonzero(active)
+        # shift by one so neighbour cells of the lowest row/column stay non-negative
+        cells = np.floor(pos[self.idxs] / self.cell_size).astype(np.int64) + 1
+        self.cells = cells
+        self._stride = cells[:, 1].max() + 2 if len(cells) else 1
+        keys = cells[:, 0] * self._stride + cells[:, 1]
+        self._order = np.argsort(keys, kind="stable")
+        self._sorted_keys = keys[self._order]
+
+    def pairs(self, radius):
+        """
+        All unordered pairs (i, j) of grid units with i < j and distance <= radius.
+        Returns unit indices i, j and their distances, as three 1D arrays.
+        """
+        assert radius <= self.cell_size, "Query radius cannot exceed the cell size"
+        n = len(self.idxs)
+        if n < 2:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+        # key of every neighbour cell of every unit, (n * 9,)
+        nb_cells = self.cells[:, None, :] + self.OFFSETS[None, :, :]
+        nb_keys = (nb_cells[..., 0] * self._stride + nb_cells[..., 1]).reshape(-1)
+        lo = np.searchsorted(self._sorted_keys, nb_keys, side="left")
+        hi = np.searchsorted(self._sorted_keys, nb_keys, side="right")
+        counts = hi - lo
+        # expand each (unit, neighbour cell) into the units of that cell
+        src = np.repeat(np.repeat(np.arange(n), len(self.OFFSETS)), counts)
+        within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        dst = self._order[np.repeat(lo, counts) + within]
+        # both orders of a pair are found, keep i < j once
+        keep = src < dst
+        src, dst = src[keep], dst[keep]
+        delta = self.pos[self.idxs[src]] - self.pos[self.idxs[dst]]
+        dist = np.hypot(delta[:, 0], delta[:, 1])
+        close = dist <= radius
+        return self.idxs[src[close]], self.idxs[dst[close]], dist[close]
+
+
+if __name__ == "__main__":
+    # Benchmark: dense distance matrix vs grid pairs for the (n, n) sight mask
+    import timeit
+
+    map_size, sight_range, reps = 64, 9.0, 200
+    rs = np.random.RandomState(0)
+
+    def dense_mask(pos):
+        delta = pos[:, None, :] - pos[None, :, :]
+        return np.hypot(delta[..., 0], delta[..., 1]) > sight_range
+
+    def grid_mask(pos):
+        i, j, _ = SpatialGrid(pos, sight_range).pairs(sight_range)
+        mask = np.ones((len(pos), len(pos)), dtype=np.bool_)
+        mask[i, j] = False
+        mask[j, i] = False
+        mask[np.diag_indices(len(pos))] = False
+        return mask
+
+    for n_units in (10, 50, 200):
+        pos = rs.rand(n_units, 2) * map_size
+        assert (dense_mask(pos) == grid_mask(pos)).all()
+        t_dense = timeit.timeit(lambda: dense_mask(pos), number=reps) / reps
+        t_grid = timeit.timeit(lambda: grid_mask(pos), number=reps) / reps
+        print("{:4d} units: dense {:8.1f}us  grid {:8.1f}us".format(n_units, t_dense * 1e6, t_grid * 1e6))
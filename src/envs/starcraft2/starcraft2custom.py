@@ -3,14 +3,20 @@ from __future__ import division
 from __future__ import print_function
 
 from ..multiagentenv import MultiAgentEnv
+from .unit_table import UnitTable
+from .spatial_grid import SpatialGrid
+from .process_pool import SC2ProcessPool
+from . import map_cache
 
 import atexit
+from collections import Counter
+import functools
 from operator import attrgetter
-from copy import deepcopy
 import numpy as np
 from numpy.random import RandomState
 import enum
 import math
+import time
 from absl import logging
 
 from pysc2 import maps
@@ -61,6 +67,25 @@ color_palette = [(0.9677975592919913, 0.44127456009157356, 0.5358103155058701),
                  (0.9603888539940703, 0.3814317878772117, 0.8683117650835491)]
 
 
+def step_cached(fn):
+    """
+    Memoises an env getter until the units change, i.e. until the next update_units()
+    or reset(), so it runs at most once per env step. Cached values are shared
+    between callers and must not be modified in place.
+    """
+    key = fn.__name__
+
+    @functools.wraps(fn)
+    def wrapper(self):
+        if key in self._step_cache:
+            self.step_cache_hits[key] += 1
+        else:
+            self.step_cache_misses[key] += 1
+            self._step_cache[key] = fn(self)
+        return self._step_cache[key]
+    return wrapper
+
+
 def get_unit_name_by_type(utype):
     if utype == 1935:
         return 'Baneling_RL'
@@ -181,6 +206,11 @@ class StarCraft2CustomEnv(MultiAgentEnv):
         heuristic_ai=False,
         heuristic_rest=False,
         pos_rotate=None,
+        spatial_grid=False,
+        check_actions=True,
+        sc2_spares=0,
+        sc2_ping_interval=30,
+        map_cache_dir=None,
         debug=False,
     ):
         """
@@ -264,6 +294,19 @@ class StarCraft2CustomEnv(MultiAgentEnv):
             Whether or not to use a non-learning heuristic AI (default False).
         pos_rotate: bool, optional
             Whether to randomly rotate starting positions (defaults to provided value in scenario dict)
+        spatial_grid: bool, optional
+            Find units within sight/shoot range with a uniform grid instead of
+            the dense distance matrix, faster for large unit counts (default is False).
+        check_actions: bool, optional
+            Assert that the actions passed to step() are available (default is True).
+        sc2_spares: int, optional
+            Number of StarCraft II instances kept launched in the background and
+            swapped in when the running one crashes (default is 0).
+        sc2_ping_interval: float, optional
+            Seconds between liveness pings of the spare instances (default is 30).
+        map_cache_dir: str, optional
+            Directory where the decoded pathing grid and terrain height are cached
+            per map and game version, shared by all workers (default is None, no cache).
         debug: bool, optional
             Log messages about observations, state, actions and rewards for
             debugging purposes (default is False).
@@ -369,6 +412,11 @@ class StarCraft2CustomEnv(MultiAgentEnv):
         self.heuristic_ai = heuristic_ai
         self.heuristic_rest = heuristic_rest
         self.debug = debug
+        self.spatial_grid = spatial_grid
+        self.check_actions = check_actions
+        self.sc2_spares = sc2_spares
+        self.sc2_ping_interval = sc2_ping_interval
+        self.map_cache_dir = map_cache_dir
         self.window_size = (window_size_x, window_size_y)
         self.replay_dir = replay_dir
         self.replay_prefix = replay_prefix
@@ -414,8 +462,14 @@ class StarCraft2CustomEnv(MultiAgentEnv):
         self.last_stats = None
         self.death_tracker_ally = np.zeros(self.n_agents)
         self.death_tracker_enemy = np.zeros(self.n_enemies)
-        self.previous_ally_units = None
-        self.previous_enemy_units = None
+        self.units = None
+        self._entity_buf = None
+        self._step_cache = {}
+        self.step_cache_hits = Counter()
+        self.step_cache_misses = Counter()
+        # wall-clock time and number of runs of each init_units phase
+        self.reset_times = Counter()
+        self.reset_counts = Counter()
         self.last_action = np.zeros((self.n_agents, self.n_actions))
         self._min_unit_type = 0
         self.max_distance_x = 0
@@ -427,6 +481,7 @@ class StarCraft2CustomEnv(MultiAgentEnv):
         self._run_config = None
         self._sc2_proc = None
         self._controller = None
+        self._process_pool = None
 
         # custom unit IDs (Assumes that map has all of these units stored in
         # its data)
@@ -472,13 +527,48 @@ class StarCraft2CustomEnv(MultiAgentEnv):
     def _launch(self):
         """Launch the StarCraft II game."""
         self._run_config = run_configs.get(version=self.game_version)
+        if self.sc2_spares > 0:
+            if self._process_pool is None:
+                self._process_pool = SC2ProcessPool(self._start_game, n_spares=self.sc2_spares,
+                                                    ping_interval=self.sc2_ping_interval)
+            self._sc2_proc, self._controller = self._process_pool.take()
+        else:
+            self._sc2_proc, self._controller = self._start_game()
+        self._bot_controller = self._controller
+
+        if self.pathing_grid is None:
+            # map metadata does not change across restarts, only decode (or load) it once
+            self._init_map_info()
+
+    def _init_map_info(self):
+        info = None
+        if self.map_cache_dir is not None:
+            version = self.game_version or getattr(getattr(self._run_config, "version", None), "game_version", None)
+            path = map_cache.cache_path(self.map_cache_dir, self.map_name, version)
+            info = map_cache.load_map_info(path)
+        if info is None:
+            info = map_cache.decode_map_info(self._controller.game_info().start_raw)
+            if self.map_cache_dir is not None:
+                map_cache.save_map_info(path, info)
+
+        self.max_distance_x = info["max_distance_x"]
+        self.max_distance_y = info["max_distance_y"]
+        self.map_x = info["map_x"]
+        self.map_y = info["map_y"]
+
+        self.map_center = (self.map_x//2,self.map_y//2)
+
+        self.pathing_grid = info["pathing_grid"]
+        self.terrain_height = info["terrain_height"]
+
+    def _start_game(self):
+        """Starts a StarCraft II process and joins a new game on the map. Returns the process and its controller."""
         _map = maps.get(self.map_name)
 
         # Setting up the interface
         interface_options = sc_pb.InterfaceOptions(raw=True, score=False)
-        self._sc2_proc = self._run_config.start(window_size=self.window_size)
-        self._controller = self._sc2_proc.controller
-        self._bot_controller = self._sc2_proc.controller
+        proc = self._run_config.start(window_size=self.window_size)
+        controller = proc.controller
 
         # Request to create the game
         create = sc_pb.RequestCreateGame(
@@ -490,64 +580,37 @@ class StarCraft2CustomEnv(MultiAgentEnv):
         create.player_setup.add(type=sc_pb.Participant)
         create.player_setup.add(type=sc_pb.Computer, race=self._bot_race,
                                 difficulty=difficulties[self.difficulty])
-        self._controller.create_game(create)
+        controller.create_game(create)
 
         join = sc_pb.RequestJoinGame(race=self._agent_race,
                                      options=interface_options)
-        self._controller.join_game(join)
-
-        game_info = self._controller.game_info()
-        map_info = game_info.start_raw
-        map_play_area_min = map_info.playable_area.p0
-        map_play_area_max = map_info.playable_area.p1
-        self.max_distance_x = map_play_area_max.x - map_play_area_min.x
-        self.max_distance_y = map_play_area_max.y - map_play_area_min.y
-        self.map_x = map_info.map_size.x
-        self.map_y = map_info.map_size.y
-
-        self.map_center = (self.map_x//2,self.map_y//2)
-
-        if map_info.pathing_grid.bits_per_pixel == 1:
-            vals = np.array(list(map_info.pathing_grid.data)).reshape(
-                self.map_x, int(self.map_y / 8))
-            self.pathing_grid = np.transpose(np.array([
-                [(b >> i) & 1 for b in row for i in range(7, -1, -1)]
-                for row in vals], dtype=np.bool))
-        else:
-            self.pathing_grid = np.invert(np.flip(np.transpose(np.array(
-                list(map_info.pathing_grid.data), dtype=np.bool).reshape(
-                    self.map_x, self.map_y)), axis=1))
-
-        self.terrain_height = np.flip(
-            np.transpose(np.array(list(map_info.terrain_height.data)).reshape(
-                self.map_x, self.map_y)), 1) / 255
+        controller.join_game(join)
+        return proc, controller
 
     def _calc_distance_mtx(self):
         # Calculate distances of all agents to all agents and enemies (for visibility calculations)
-        dist_mtx = 1000 * np.ones((self.n_agents + self.n_enemies, self.n_agents + self.n_enemies))
-        for i in range(self.n_agents + self.n_enemies):
-            for j in range(self.n_agents + self.n_enemies):
-                if j < i:
-                    continue
-                elif j == i:
-                    dist_mtx[i, j] = 0.0
-                else:
-                    if i >= self.n_agents:
-                        unit_a = self.enemies[i - self.n_agents]
-                    else:
-                        unit_a = self.agents[i]
-                    if j >= self.n_agents:
-                        unit_b = self.enemies[j - self.n_agents]
-                    else:
-                        unit_b = self.agents[j]
-                    if unit_a.health > 0 and unit_b.health > 0:
-                        dist = self.distance(unit_a.pos.x, unit_a.pos.y,
-                                             unit_b.pos.x, unit_b.pos.y)
-                        dist_mtx[i, j] = dist
-                        if j < self.n_agents:
-                            dist_mtx[j, i] = dist
+        # Only pairs i < j of living units are filled, and mirrored below the diagonal for ally pairs
+        n_units = self.n_agents + self.n_enemies
+        pos, health = self._unit_arrays()
+        if self.spatial_grid:
+            # only the (i < j) pairs of living units within the largest range, found in near-linear time
+            max_range = max(self.sight_ranges.max(), self.shoot_ranges.max())
+            self.unit_pairs = SpatialGrid(pos, max_range, active=health > 0).pairs(max_range)
+            self.dist_mtx = None
+            return
+        delta = pos[:, None, :] - pos[None, :, :]
+        dist = np.hypot(delta[..., 0], delta[..., 1])
+        alive = health > 0
+        fill = np.triu(alive[:, None] & alive[None, :], k=1)
+        fill[:self.n_agents, :self.n_agents] |= fill[:self.n_agents, :self.n_agents].T
+        dist_mtx = np.where(fill, dist, 1000.0)
+        dist_mtx[np.diag_indices(n_units)] = 0.0
         self.dist_mtx = dist_mtx
 
+    def _unit_arrays(self):
+        """Positions (n_units, 2) and health (n_units,) of agents followed by enemies."""
+        return np.stack([self.units.x, self.units.y], axis=1), self.units.health
+
     def reset(self, unit_override=None, test=False, index=None):
         """Reset the environment. Required after each full episode.
         Returns initial observations and states.
@@ -566,8 +629,6 @@ class StarCraft2CustomEnv(MultiAgentEnv):
         # Information kept for counting the reward
         self.death_tracker_ally = np.zeros(self.n_agents)
         self.death_tracker_enemy = np.zeros(self.n_enemies)
-        self.previous_ally_units = None
-        self.previous_enemy_units = None
         self.win_counted = False
         self.defeat_counted = False
 
@@ -580,6 +641,7 @@ class StarCraft2CustomEnv(MultiAgentEnv):
             logging.debug("Started Episode {}"
                           .format(self._episode_count).center(60, "*"))
 
+        self._step_cache.clear()
         self._calc_distance_mtx()
 
         if self.entity_scheme:
@@ -588,8 +650,13 @@ class StarCraft2CustomEnv(MultiAgentEnv):
 
     def full_restart(self):
         """Full restart. Closes the SC2 process and launches a new one. """
-        self._sc2_proc.close()
-        self._launch()
+        if self._process_pool is not None:
+            # swap in a spare already in a game on the same map, the broken one is closed in the background
+            self._sc2_proc, self._controller = self._process_pool.swap(self._sc2_proc)
+            self._bot_controller = self._controller
+        else:
+            self._sc2_proc.close()
+            self._launch()
         self.force_restarts += 1
 
     def try_controller_step(self, fn=lambda: None, n_steps=1):
@@ -605,24 +672,25 @@ class StarCraft2CustomEnv(MultiAgentEnv):
 
     def step(self, actions, render_fn=None):
         """A single environment step. Returns reward, terminated, info."""
-        actions = [int(a) for a in actions[:self.n_agents]]
+        actions = np.asarray(actions[:self.n_agents], dtype=np.int64)
 
-        self.last_action = np.eye(self.n_actions)[np.array(actions)]
+        self.last_action.fill(0)
+        self.last_action[np.arange(self.n_agents), actions] = 1
 
         # Collect individual actions
-        sc_actions = []
         if self.debug:
             logging.debug("Actions".center(60, "-"))
 
-        for a_id, action in enumerate(actions):
-            if not self.heuristic_ai:
-                agent_action = self.get_agent_action(a_id, action)
-            else:
+        if not self.heuristic_ai:
+            sc_actions = self.get_agent_actions(actions)
+        else:
+            sc_actions = []
+            for a_id, action in enumerate(actions):
                 agent_action, action_num = self.get_agent_action_heuristic(
-                    a_id, action)
+                    a_id, int(action))
                 actions[a_id] = action_num
-            if agent_action:
-                sc_actions.append(agent_action)
+                if agent_action:
+                    sc_actions.append(agent_action)
 
         # Send action request
         req_actions = sc_pb.RequestAction(actions=sc_actions)
@@ -788,6 +856,59 @@ class StarCraft2CustomEnv(MultiAgentEnv):
         sc_action = sc_pb.Action(action_raw=r_pb.ActionRaw(unit_command=cmd))
         return sc_action
 
+    def get_agent_actions(self, agent_actions):
+        """
+        Construct the actions of all agents at once. Agents issuing the same command
+        (stop, or attack/heal on the same target) share one multi-tag ActionRawUnitCommand,
+        moves have a per-unit target point so they stay one command per agent.
+        """
+        n_agents = self.n_agents
+        units = self.units
+        if self.check_actions:
+            avail = self.get_avail_actions()[np.arange(n_agents), agent_actions]
+            assert avail.all(), "Agents {} cannot perform actions {}".format(
+                np.flatnonzero(avail == 0), agent_actions[avail == 0])
+        if self.debug:
+            for a_id, action in enumerate(agent_actions):
+                logging.debug("Agent {}: action {}".format(a_id, action))
+
+        tags = [int(tag) for tag in units.tag[:n_agents]]
+        cmds = []
+        stop = np.flatnonzero(agent_actions == 1)
+        if len(stop):
+            cmds.append(r_pb.ActionRawUnitCommand(
+                ability_id=actions["stop"],
+                unit_tags=[tags[a_id] for a_id in stop],
+                queue_command=False))
+
+        move = np.flatnonzero((agent_actions >= 2) & (agent_actions < self.n_actions_no_attack))
+        if len(move):
+            # north, south, east, west
+            delta = np.array([(0, 1), (0, -1), (1, 0), (-1, 0)]) * self._move_amount
+            target_x = units.x[move] + delta[agent_actions[move] - 2, 0]
+            target_y = units.y[move] + delta[agent_actions[move] - 2, 1]
+            for a_id, x, y in zip(move, target_x, target_y):
+                cmds.append(r_pb.ActionRawUnitCommand(
+                    ability_id=actions["move"],
+                    target_world_space_pos=sc_common.Point2D(x=x, y=y),
+                    unit_tags=[tags[a_id]],
+                    queue_command=False))
+
+        attack = np.flatnonzero(agent_actions >= self.n_actions_no_attack)
+        if len(attack):
+            # action index -> target slot in the unit table, medivacs heal allies, others attack enemies
+            target_slots = self.entity_tag_slot[agent_actions[attack] - self.n_actions_no_attack]
+            heal = self.is_medivac[attack]
+            for target_slot, ability in set(zip(target_slots, heal)):
+                group = attack[(target_slots == target_slot) & (heal == ability)]
+                cmds.append(r_pb.ActionRawUnitCommand(
+                    ability_id=actions["heal" if ability else "attack"],
+                    target_unit_tag=int(units.tag[target_slot]),
+                    unit_tags=[tags[a_id] for a_id in group],
+                    queue_command=False))
+
+        return [sc_pb.Action(action_raw=r_pb.ActionRaw(unit_command=cmd)) for cmd in cmds]
+
     def get_agent_action_heuristic(self, a_id, action):
         unit = self.get_unit_by_id(a_id)
         tag = unit.tag
@@ -904,37 +1025,24 @@ class StarCraft2CustomEnv(MultiAgentEnv):
         neg_scale = self.reward_negative_scale
 
         # update deaths
-        for al_id, al_unit in self.agents.items():
-            if not self.death_tracker_ally[al_id]:
-                # did not die so far
-                prev_health = (
-                    self.previous_ally_units[al_id].health +
-                    self.previous_ally_units[al_id].shield
-                )
-                if al_unit.health == 0:
-                    # just died
-                    self.death_tracker_ally[al_id] = 1
-                    if not self.reward_only_positive:
-                        delta_deaths -= self.reward_death_value * neg_scale
-                    delta_ally += prev_health * neg_scale
-                else:
-                    # still alive
-                    delta_ally += neg_scale * (
-                        prev_health - al_unit.health - al_unit.shield
-                    )
-
-        for e_id, e_unit in self.enemies.items():
-            if not self.death_tracker_enemy[e_id]:
-                prev_health = (
-                    self.previous_enemy_units[e_id].health +
-                    self.previous_enemy_units[e_id].shield
-                )
-                if e_unit.health == 0:
-                    self.death_tracker_enemy[e_id] = 1
-                    delta_deaths += self.reward_death_value
-                    delta_enemy += prev_health
-                else:
-                    delta_enemy += prev_health - e_unit.health - e_unit.shield
+        units = self.units
+        prev_health = units.prev("health") + units.prev("shield")
+        # damage taken this step by units that were still alive, or their last health if they just died
+        damage = np.where(units.health == 0, prev_health, prev_health - units.health - units.shield)
+        died = units.health == 0
+
+        ally_live = self.death_tracker_ally == 0
+        ally_died = ally_live & died[:self.n_agents]
+        self.death_tracker_ally[ally_died] = 1
+        if not self.reward_only_positive:
+            delta_deaths -= self.reward_death_value * neg_scale * int(ally_died.sum())
+        delta_ally += neg_scale * float(damage[:self.n_agents][ally_live].sum())
+
+        enemy_live = self.death_tracker_enemy == 0
+        enemy_died = enemy_live & died[self.n_agents:]
+        self.death_tracker_enemy[enemy_died] = 1
+        delta_deaths += self.reward_death_value * int(enemy_died.sum())
+        delta_enemy += float(damage[self.n_agents:][enemy_live].sum())
 
         if self.reward_only_positive:
             reward = abs(delta_enemy + delta_deaths)  # shield regeneration
@@ -1031,19 +1139,33 @@ class StarCraft2CustomEnv(MultiAgentEnv):
         ]
         return vals
 
+    @step_cached
     def get_masks(self):
         """
         Returns:
         1) per agent observability mask over all entities (unoberserved = 1, else 0)
         3) mask of inactive entities (including enemies) over all possible entities
         """
-        sight_range = np.array(
-            [self.unit_sight_range(a_i)
-             for a_i in range(self.n_agents + self.n_enemies)]).reshape(-1, 1)
-        obs_mask = (self.dist_mtx > sight_range).astype(np.uint8)
         obs_mask_padded = np.ones((self.max_n_agents + self.max_n_enemies,
                                    self.max_n_agents + self.max_n_enemies),
                                   dtype=np.uint8)
+        entity_mask = np.ones(self.max_n_agents + self.max_n_enemies,
+                              dtype=np.uint8)
+        entity_mask[:self.n_agents] = 0
+        entity_mask[self.max_n_agents:self.max_n_agents + self.n_enemies] = 0
+        if self.spatial_grid:
+            # write the pairs in range straight into the padded layout, same visibility as the
+            # dense matrix: i sees j for i < j, allies also see each other back, units see themselves
+            rows = self._entity_rows(np.ones(self.n_agents + self.n_enemies, dtype=np.bool_))
+            i, j, dist = self.unit_pairs
+            seen = dist <= self.sight_ranges[i]
+            obs_mask_padded[rows[i[seen]], rows[j[seen]]] = 0
+            seen_back = (j < self.n_agents) & (dist <= self.sight_ranges[j])
+            obs_mask_padded[rows[j[seen_back]], rows[i[seen_back]]] = 0
+            obs_mask_padded[rows, rows] = 0
+            return obs_mask_padded, entity_mask
+
+        obs_mask = (self.dist_mtx > self.sight_ranges[:, None]).astype(np.uint8)
         obs_mask_padded[:self.n_agents,
                         :self.n_agents] = obs_mask[:self.n_agents, :self.n_agents]
         obs_mask_padded[:self.n_agents,
@@ -1056,94 +1178,104 @@ class StarCraft2CustomEnv(MultiAgentEnv):
                         self.max_n_agents:self.max_n_agents + self.n_enemies] = (
                             obs_mask[self.n_agents:, self.n_agents:]
         )
-        entity_mask = np.ones(self.max_n_agents + self.max_n_enemies,
-                              dtype=np.uint8)
-        entity_mask[:self.n_agents] = 0
-        entity_mask[self.max_n_agents:self.max_n_agents + self.n_enemies] = 0
         return obs_mask_padded, entity_mask
 
+    @step_cached
     def get_entities(self):
         """
-        Returns list of agent entities and enemy entities in the map (all entities are a fixed size)
+        Returns agent entities and enemy entities in the map as one (max_n_agents + max_n_enemies, entity_size)
+        float32 array, agents in the first max_n_agents rows and enemies after them (padding rows are zeros).
         All entities together form the global state
         For decentralized execution agents should only have access to the
         entities specified by get_masks()
+        NOTE: the array is reused across steps, copy it if it has to outlive the next call
         """
-        all_units = list(self.agents.values()) + list(self.enemies.values())
-
+        units = self.units
+        n_agents = self.n_agents
+        n_entities = self.max_n_agents + self.max_n_enemies
         nf_entity = self.get_entity_size()
-
-        center_x = self.map_x / 2
-        center_y = self.map_y / 2
-        com_x = sum(unit.pos.x for unit in all_units) / len(all_units)
-        com_y = sum(unit.pos.y for unit in all_units) / len(all_units)
-        max_dist_com = max(self.distance(unit.pos.x, unit.pos.y, com_x, com_y)
-                           for unit in all_units)
-
-        entities = []
+        if self._entity_buf is None or self._entity_buf.shape != (n_entities, nf_entity):
+            self._entity_buf = np.zeros((n_entities, nf_entity), dtype=np.float32)
+        entities = self._entity_buf
+        entities.fill(0)
+
+        # row of each unit in the padded entity array
+        rows = np.concatenate([np.arange(n_agents),
+                               self.max_n_agents + np.arange(self.n_enemies)])
+        # entity tag
+        entities[rows, np.concatenate([self.ally_tags, self.enemy_tags])] = 1
+        ind = self.max_n_agents + self.max_n_enemies + 2 * self.n_extra_tags
+        # available actions (if user controlled entity)
         avail_actions = self.get_avail_actions()
-        for u_i, unit in enumerate(all_units):
-            entity = np.zeros(nf_entity, dtype=np.float32)
-            # entity tag
-            if u_i < self.n_agents:
-                tag = self.ally_tags[u_i]
-            else:
-                tag = self.enemy_tags[u_i - self.n_agents]
-            entity[tag] = 1
-            ind = self.max_n_agents + self.max_n_enemies + 2 * self.n_extra_tags
-            # available actions (if user controlled entity)
-            if u_i < self.n_agents:
-                for ac_i in range(self.n_actions - 2):
-                    entity[ind + ac_i] = avail_actions[u_i][2 + ac_i]
-            ind += self.n_actions - 2
-            # unit type
-            if self.unit_type_bits > 0:
-                type_id = self.unit_type_ids[unit.unit_type]
-                entity[ind + type_id] = 1
-                ind += self.unit_type_bits
-            if unit.health > 0:  # otherwise dead, return all zeros
-                # health and shield
-                if self.obs_all_health or self.obs_own_health:
-                    entity[ind] = unit.health / unit.health_max
-                    if ((self.shield_bits_ally > 0 and u_i < self.n_agents) or
-                            (self.shield_bits_enemy > 0 and
-                             u_i >= self.n_agents)):
-                        entity[ind + 1] = unit.shield / unit.shield_max
-                    ind += 1 + int(self.shield_bits_ally or
-                                   self.shield_bits_enemy)
-                # energy and cooldown (for ally units only)
-                if u_i < self.n_agents:
-                    if unit.energy_max > 0.0:
-                        entity[ind] = unit.energy / unit.energy_max
-                    entity[ind + 1] = unit.weapon_cooldown / self.unit_max_cooldown(unit)
-                ind += 2
-                # x-y positions
-                entity[ind] = (unit.pos.x - center_x) / self.max_distance_x
-                entity[ind + 1] = (unit.pos.y - center_y) / self.max_distance_y
-                entity[ind + 2] = (unit.pos.x - com_x) / max_dist_com
-                entity[ind + 3] = (unit.pos.y - com_y) / max_dist_com
-                ind += 4
-                if self.obs_pathing_grid:
-                    entity[
-                        ind:ind + self.n_obs_pathing
-                    ] = self.get_surrounding_pathing(unit)
-                    ind += self.n_obs_pathing
-                if self.obs_terrain_height:
-                    entity[ind:] = self.get_surrounding_height(unit)
-
-            entities.append(entity)
-            # pad entities to fixed number across episodes (for easier batch processing)
-            if u_i == self.n_agents - 1:
-                entities += [np.zeros(nf_entity, dtype=np.float32)
-                             for _ in range(self.max_n_agents -
-                                            self.n_agents)]
-            elif u_i == self.n_agents + self.n_enemies - 1:
-                entities += [np.zeros(nf_entity, dtype=np.float32)
-                             for _ in range(self.max_n_enemies -
-                                            self.n_enemies)]
+        entities[:n_agents, ind:ind + self.n_actions - 2] = avail_actions[:n_agents, 2:]
+        ind += self.n_actions - 2
+        # unit type
+        if self.unit_type_bits > 0:
+            entities[rows, ind + self.unit_type_idx] = 1
+            ind += self.unit_type_bits
+
+        # below are only filled for alive units, dead ones keep zeros
+        alive = units.health > 0
+        al_alive = alive[:n_agents]
+        rows = rows[alive]
+        # health and shield
+        if self.obs_all_health or self.obs_own_health:
+            entities[rows, ind] = units.health[alive] / units.health_max[alive]
+            has_shield = np.zeros(len(alive), dtype=np.bool_)
+            has_shield[:n_agents] = self.shield_bits_ally > 0
+            has_shield[n_agents:] = self.shield_bits_enemy > 0
+            shield_rows = has_shield & alive
+            if shield_rows.any():
+                entities[self._entity_rows(shield_rows), ind + 1] = (
+                    units.shield[shield_rows] / units.shield_max[shield_rows])
+            ind += 1 + int(self.shield_bits_ally or self.shield_bits_enemy)
+        # energy and cooldown (for ally units only)
+        energy_max = units.energy_max[:n_agents]
+        has_energy = al_alive & (energy_max > 0.0)
+        entities[:n_agents][has_energy, ind] = units.energy[:n_agents][has_energy] / energy_max[has_energy]
+        entities[:n_agents][al_alive, ind + 1] = (units.weapon_cooldown[:n_agents][al_alive] /
+                                                  self.unit_max_cooldowns[:n_agents][al_alive])
+        ind += 2
+        # x-y positions
+        x, y = units.x[alive], units.y[alive]
+        com_x = units.x.mean()
+        com_y = units.y.mean()
+        max_dist_com = np.hypot(units.x - com_x, units.y - com_y).max()
+        entities[rows, ind] = (x - self.map_x / 2) / self.max_distance_x
+        entities[rows, ind + 1] = (y - self.map_y / 2) / self.max_distance_y
+        entities[rows, ind + 2] = (x - com_x) / max_dist_com
+        entities[rows, ind + 3] = (y - com_y) / max_dist_com
+        ind += 4
+        if self.obs_pathing_grid:
+            entities[rows, ind:ind + self.n_obs_pathing] = self._surrounding_values(
+                self.pathing_grid, x, y, include_self=False)
+            ind += self.n_obs_pathing
+        if self.obs_terrain_height:
+            entities[rows, ind:] = self._surrounding_values(
+                self.terrain_height, x, y, include_self=True)
 
         return entities
 
+    def _entity_rows(self, unit_mask):
+        """Rows in the padded entity array of the units selected by unit_mask."""
+        slots = np.flatnonzero(unit_mask)
+        return np.where(slots < self.n_agents, slots, slots - self.n_agents + self.max_n_agents)
+
+    def _surrounding_values(self, grid, x, y, include_self=False):
+        """
+        Vectorised get_surrounding_pathing/get_surrounding_height: values of grid at
+        the 8 (9 with include_self) points around each position, 1 when out of bounds.
+        """
+        ma = self._move_amount
+        offsets = np.array([(0, 2 * ma), (0, -2 * ma), (2 * ma, 0), (-2 * ma, 0),
+                            (ma, ma), (-ma, -ma), (ma, -ma), (-ma, ma)] +
+                           ([(0, 0)] if include_self else []))
+        px = x.astype(np.int64)[:, None] + offsets[:, 0]
+        py = y.astype(np.int64)[:, None] + offsets[:, 1]
+        in_bounds = (px >= 0) & (px < self.map_x) & (py >= 0) & (py < self.map_y)
+        vals = grid[np.where(in_bounds, px, 0), np.where(in_bounds, py, 0)]
+        return np.where(in_bounds, vals, 1)
+
     def get_entity_size(self):
         nf_entity = self.max_n_agents + self.max_n_enemies + 2 * self.n_extra_tags  # tag
         nf_entity += self.n_actions - 2  # available actions minus those that are always available
@@ -1324,6 +1456,7 @@ class StarCraft2CustomEnv(MultiAgentEnv):
 
         return agent_obs
 
+    @step_cached
     def get_obs(self):
         """Returns all agent observations in a list.
         NOTE: Agents should have access only to their local observations
@@ -1356,6 +1489,7 @@ class StarCraft2CustomEnv(MultiAgentEnv):
         }
         return switcher.get(unit.unit_type, 15)
 
+    @step_cached
     def get_state(self):
         """Returns the global state.
         NOTE: This functon should not be used during decentralised execution.
@@ -1499,67 +1633,67 @@ class StarCraft2CustomEnv(MultiAgentEnv):
 
     def get_avail_agent_actions(self, agent_id):
         """Returns the available actions for agent_id."""
-        unit = self.get_unit_by_id(agent_id)
-        if unit.health > 0:
-            # cannot choose no-op when alive
-            avail_actions = [0] * self.n_actions
-
-            # stop should be allowed
-            avail_actions[1] = 1
-
-            # see if we can move
-            if self.can_move(unit, Direction.NORTH):
-                avail_actions[2] = 1
-            if self.can_move(unit, Direction.SOUTH):
-                avail_actions[3] = 1
-            if self.can_move(unit, Direction.EAST):
-                avail_actions[4] = 1
-            if self.can_move(unit, Direction.WEST):
-                avail_actions[5] = 1
-
-            # Can attack only alive units that are alive in the shooting range
-            shoot_range = self.unit_shoot_range(agent_id)
-
-            if unit.unit_type in (self.medivac_id, Terran.Medivac):
-                # Medivacs cannot heal themselves or other flying units
-                target_items = [
-                    (t_id, t_unit)
-                    for (t_id, t_unit) in self.agents.items()
-                    if not t_unit.is_flying
-                ]
-                dist_offset = 0
-            else:
-                target_items = list(self.enemies.items())
-                dist_offset = self.n_agents
-
-            for t_id, t_unit in target_items:
-                dist = self.dist_mtx[agent_id, t_id + dist_offset]
-                if dist <= shoot_range:
-                    if unit.unit_type in (self.medivac_id, Terran.Medivac):
-                        tag = self.ally_tags[t_id]
-                    else:
-                        tag = self.enemy_tags[t_id]
-                    avail_actions[tag + self.n_actions_no_attack] = 1
+        return self.get_avail_actions()[agent_id]
 
+    @step_cached
+    def get_avail_actions(self):
+        """Returns the available actions of all agents as a (max_n_agents, n_actions) array."""
+        units = self.units
+        n_agents = self.n_agents
+        avail_actions = np.zeros((self.max_n_agents, self.n_actions), dtype=np.int64)
+        # dead and padded agents can only no-op
+        avail_actions[:, 0] = 1
+        alive = units.health[:n_agents] > 0
+        if not alive.any():
             return avail_actions
+        al_avail = avail_actions[:n_agents]
+        # cannot choose no-op when alive, stop should be allowed
+        al_avail[:, 0] = ~alive
+        al_avail[:, 1] = alive
 
-        else:
-            # only no-op allowed
-            return [1] + [0] * (self.n_actions - 1)
-
-    def get_avail_actions(self):
-        """Returns the available actions of all agents in a list."""
-        avail_actions = []
-        for agent_id in range(self.max_n_agents):
-            if agent_id < self.n_agents:
-                avail_agent = self.get_avail_agent_actions(agent_id)
-            else:
-                avail_agent = [1] + [0] * (self.n_actions - 1)
-            avail_actions.append(avail_agent)
+        # see if we can move (north, south, east, west)
+        m = self._move_amount / 2
+        px = (units.x[:n_agents, None] + np.array([0, 0, m, -m])).astype(np.int64)
+        py = (units.y[:n_agents, None] + np.array([m, -m, 0, 0])).astype(np.int64)
+        in_bounds = (px >= 0) & (px < self.map_x) & (py >= 0) & (py < self.map_y)
+        can_move = in_bounds & self.pathing_grid[np.where(in_bounds, px, 0), np.where(in_bounds, py, 0)]
+        al_avail[:, 2:6] = can_move & alive[:, None]
+
+        # Can attack only alive units that are alive in the shooting range
+        is_medivac = self.is_medivac
+        in_range = self._agents_in_range(self.shoot_ranges)
+        if Terran.Medivac in self.unit_types:
+            # heal actions only exist in the action space when medivacs can be spawned
+            # Medivacs cannot heal themselves or other flying units
+            heal = in_range[:, :n_agents] & ~units.is_flying[None, :n_agents] & (alive & is_medivac)[:, None]
+            al_avail[:, self.n_actions_no_attack + np.asarray(self.ally_tags)] |= heal
+        attack = in_range[:, n_agents:] & (alive & ~is_medivac)[:, None]
+        al_avail[:, self.n_actions_no_attack + np.asarray(self.enemy_tags)] |= attack
         return avail_actions
 
+    def _agents_in_range(self, ranges):
+        """(n_agents, n_units) bool, whether each unit is within ranges[agent] of the agent."""
+        n_agents = self.n_agents
+        if not self.spatial_grid:
+            return self.dist_mtx[:n_agents] <= ranges[:, None]
+        in_range = np.zeros((n_agents, n_agents + self.n_enemies), dtype=np.bool_)
+        in_range[np.arange(n_agents), np.arange(n_agents)] = True
+        i, j, dist = self.unit_pairs
+        ally = i < n_agents
+        i, j, dist = i[ally], j[ally], dist[ally]
+        close = dist <= ranges[i]
+        in_range[i[close], j[close]] = True
+        # ally pairs are symmetric
+        ally = j < n_agents
+        i, j, dist = i[ally], j[ally], dist[ally]
+        close = dist <= ranges[j]
+        in_range[j[close], i[close]] = True
+        return in_range
+
     def close(self):
         """Close StarCraft II."""
+        if self._process_pool is not None:
+            self._process_pool.close()
         if self._sc2_proc:
             self._sc2_proc.close()
 
@@ -1642,23 +1776,26 @@ class StarCraft2CustomEnv(MultiAgentEnv):
         image = np.frombuffer(self.canvas.tostring_rgb(), dtype='uint8').reshape(int(height), int(width), 3)
         return image
 
-    def _kill_all_units(self):
-        """Kill all units on the map."""
-        self._obs = self._controller.observe()
-        tags = [u.tag for u in self._obs.observation.raw_data.units]
-        debug_command = [
-            d_pb.DebugCommand(kill_unit=d_pb.DebugKillUnit(tag=tags))
-        ]
-        self.try_controller_step(lambda: self._controller.debug(debug_command),
-                                 n_steps=2)
+    def _units_spawned(self, old_tags):
+        """Whether the last observation has exactly the new armies, and none of old_tags."""
+        units = self._obs.observation.raw_data.units
+        return (len(units) == self.n_agents + self.n_enemies and
+                not any(unit.tag in old_tags for unit in units))
 
-        while(len(self._obs.observation.raw_data.units) != 0):
-            self.try_controller_step(n_steps=1)
+    def _add_reset_time(self, phase, t_start, t_end):
+        self.reset_times[phase] += t_end - t_start
+        self.reset_counts[phase] += 1
 
     def init_units(self, unit_override=None, index=None):
         """Initialise the units."""
         while True:
-            self._kill_all_units()
+            t_start = time.perf_counter()
+            # the previous units are killed in the same debug request that creates the new ones
+            self._obs = self._controller.observe()
+            old_tags = set(u.tag for u in self._obs.observation.raw_data.units)
+            cmds = []
+            if old_tags:
+                cmds.append(d_pb.DebugCommand(kill_unit=d_pb.DebugKillUnit(tag=list(old_tags))))
 
             self.n_agents = 0
             if not self.max_reward_init:
@@ -1680,7 +1817,6 @@ class StarCraft2CustomEnv(MultiAgentEnv):
                 ally_army, enemy_army = armies
             else:
                 ally_army, enemy_army = unit_override
-            cmds = []
             for num, unit_type, pos in ally_army:
                 sc_pos = sc_common.Point2D(x=self.map_center[0] + pos[0],
                                            y=self.map_center[1] + pos[1])
@@ -1709,8 +1845,7 @@ class StarCraft2CustomEnv(MultiAgentEnv):
                 self.n_enemies += num
             self._controller.debug(cmds)
             step_success = True
-            while(len(self._obs.observation.raw_data.units) !=
-                  self.n_agents + self.n_enemies):
+            while not self._units_spawned(old_tags):
                 step_success = self.try_controller_step(n_steps=2)
                 if not step_success:
                     # StarCraft crashed so we need to retry initialization
@@ -1726,6 +1861,8 @@ class StarCraft2CustomEnv(MultiAgentEnv):
                     if unit.owner == 2:
                         self.max_reward += unit.health_max + unit.shield_max
             self.max_reward_init = True
+        t_spawned = time.perf_counter()
+        self._add_reset_time("spawn", t_start, t_spawned)
 
         self.agents = {}
         self.enemies = {}
@@ -1779,11 +1916,29 @@ class StarCraft2CustomEnv(MultiAgentEnv):
         for i in range(len(enemy_units_sorted)):
             self.enemies[i] = enemy_units_sorted[i]
 
+        self.units = UnitTable([self.agents[i] for i in range(len(self.agents))] +
+                               [self.enemies[i] for i in range(len(self.enemies))])
+        self.unit_max_cooldowns = np.array([self.unit_max_cooldown(unit) for unit in
+                                            list(self.agents.values()) + list(self.enemies.values())])
+        self.sight_ranges = np.array([self.unit_sight_range(u_i) for u_i in range(self.units.n_units)])
+        self.shoot_ranges = np.array([self.unit_shoot_range(a_id) for a_id in range(len(self.agents))])
+        self.is_medivac = np.isin(self.units.unit_type[:len(self.agents)], (self.medivac_id, Terran.Medivac))
+        # attack/heal target index (entity tag) -> unit slot in the table
+        self.entity_tag_slot = np.full(self.max_n_agents + self.max_n_enemies + 2 * self.n_extra_tags, -1)
+        self.entity_tag_slot[self.ally_tags] = np.arange(len(self.agents))
+        self.entity_tag_slot[self.enemy_tags] = len(self.agents) + np.arange(len(self.enemies))
+        if self.unit_type_bits > 0:
+            self.unit_type_idx = np.array([self.unit_type_ids[int(unit_type)] for unit_type in self.units.unit_type])
+
+        t_setup = time.perf_counter()
+        self._add_reset_time("setup", t_spawned, t_setup)
+
         # control enemy so we can set their attack point based on ally loc
         cmd = d_pb.DebugCommand(
             game_state=d_pb.DebugGameState.control_enemy)
         step_success = self.try_controller_step(fn=lambda: self._controller.debug([cmd]),
                                                 n_steps=4)
+        self._add_reset_time("control_enemy", t_setup, time.perf_counter())
         if not step_success:
             self.init_units(unit_override=unit_override, index=index)
             return
@@ -1808,36 +1963,25 @@ class StarCraft2CustomEnv(MultiAgentEnv):
         """Update units after an environment step.
         This function assumes that self._obs is up-to-date.
         """
-        n_ally_alive = 0
-        n_enemy_alive = 0
-
-        # Store previous state
-        self.previous_ally_units = deepcopy(self.agents)
-        self.previous_enemy_units = deepcopy(self.enemies)
-
-        for al_id, al_unit in self.agents.items():
-            updated = False
-            for unit in self._obs.observation.raw_data.units:
-                if al_unit.tag == unit.tag:
-                    self.agents[al_id] = unit
-                    updated = True
-                    n_ally_alive += 1
-                    break
-
-            if not updated:  # dead
-                al_unit.health = 0
-
-        for e_id, e_unit in self.enemies.items():
-            updated = False
-            for unit in self._obs.observation.raw_data.units:
-                if e_unit.tag == unit.tag:
-                    self.enemies[e_id] = unit
-                    updated = True
-                    n_enemy_alive += 1
-                    break
+        self._step_cache.clear()
+        # the unit table keeps the previous step for the reward, the dicts keep the raw units
+        found = self.units.update(self._obs.observation.raw_data.units)
+        seen = set()
+        for slot, unit in found:
+            if slot < self.n_agents:
+                self.agents[slot] = unit
+            else:
+                self.enemies[slot - self.n_agents] = unit
+            seen.add(slot)
+        for slot in range(self.units.n_units):
+            if slot not in seen:  # dead
+                if slot < self.n_agents:
+                    self.agents[slot].health = 0
+                else:
+                    self.enemies[slot - self.n_agents].health = 0
 
-            if not updated:  # dead
-                e_unit.health = 0
+        n_ally_alive = len([slot for slot in seen if slot < self.n_agents])
+        n_enemy_alive = len(seen) - n_ally_alive
 
         if (n_ally_alive == 0 and n_enemy_alive > 0 or
                 self.only_medivac_left(ally=True)):
@@ -1855,25 +1999,14 @@ class StarCraft2CustomEnv(MultiAgentEnv):
         if (Terran.Medivac not in self.unit_type_ids) and self.medivac_id not in self.unit_type_ids:
             return False
 
+        units = self.units
         if ally:
-            units_alive = [
-                a
-                for a in self.agents.values()
-                if (a.health > 0 and a.unit_type not in (Terran.Medivac,
-                                                         self.medivac_id))
-            ]
-            if len(units_alive) == 0:
-                return True
-            return False
+            alive = units.health[:self.n_agents] > 0
+            not_medivac = ~np.isin(units.unit_type[:self.n_agents], (Terran.Medivac, self.medivac_id))
         else:
-            units_alive = [
-                a
-                for a in self.enemies.values()
-                if (a.health > 0 and a.unit_type != Terran.Medivac)
-            ]
-            if len(units_alive) == 0:
-                return True
-            return False
+            alive = units.health[self.n_agents:] > 0
+            not_medivac = units.unit_type[self.n_agents:] != Terran.Medivac
+        return not (alive & not_medivac).any()
 
     def get_unit_by_id(self, a_id):
         """Get unit by ID."""
@@ -1887,7 +2020,13 @@ class StarCraft2CustomEnv(MultiAgentEnv):
             "win_rate": self.battles_won / self.battles_game,
             "timeouts": self.timeouts,
             "restarts": self.force_restarts,
+            "step_cache_hits": sum(self.step_cache_hits.values()),
+            "step_cache_misses": sum(self.step_cache_misses.values()),
         }
+        if self._process_pool is not None:
+            stats.update({"sc2_spare_" + k: v for k, v in self._process_pool.stats.items()})
+        for phase, total in self.reset_times.items():
+            stats["reset_{}_ms".format(phase)] = 1000 * total / self.reset_counts[phase]
         return stats
 
     def get_env_info(self, args):
@@ -0,0 +1,84 @@
+import numpy as np
+
+
+class UnitTable:
+    """
+    Structure-of-arrays state of the units in an episode, agents first then enemies.
+    Slots are fixed when the units are created and refreshed in place from each
+    observation through a tag -> slot map. The previous step lives in a second set
+    of arrays that is swapped in on update instead of deep-copying protobuf units.
+    """
+    FIELDS = (
+        ("tag", np.uint64),
+        ("unit_type", np.int64),
+        ("x", np.float64),
+        ("y", np.float64),
+        ("health", np.float64),
+        ("health_max", np.float64),
+        ("shield", np.float64),
+        ("shield_max", np.float64),
+        ("energy", np.float64),
+        ("energy_max", np.float64),
+        ("weapon_cooldown", np.float64),
+        ("is_flying", np.bool_),
+        ("alive", np.bool_),
+    )
+
+    def __init__(self, units):
+        self.n_units = len(units)
+        self._cur = {name: np.zeros(self.n_units, dtype=dtype) for name, dtype in self.FIELDS}
+        self._prev = {name: np.zeros(self.n_units, dtype=dtype) for name, dtype in self.FIELDS}
+        self.tag_to_slot = {unit.tag: slot for slot, unit in enumerate(units)}
+        for slot, unit in enumerate(units):
+            self._write(slot, unit)
+        self._cur["alive"][:] = self._cur["health"] > 0
+        for name, arr in self._cur.items():
+            self._prev[name][:] = arr
+        self._bind()
+
+    def update(self, raw_units):
+        """
+        Swaps buffers and refreshes the current one from raw_units.
+        Units missing from raw_units are dead: their health drops to 0 and their other
+        fields keep the last observed values. Returns the (slot, unit) pairs found.
+        """
+        self._cur, self._prev = self._prev, self._cur
+        for name, arr in self._cur.items():
+            np.copyto(arr, self._prev[name])
+        found = []
+        tag_to_slot = self.tag_to_slot
+        for unit in raw_units:
+            slot = tag_to_slot.get(unit.tag)
+            if slot is not None:
+                self._write(slot, unit)
+                found.append((slot, unit))
+        alive = np.zeros(self.n_units, dtype=np.bool_)
+        alive[[slot for slot, _ in found]] = True
+        self._cur["health"][~alive] = 0
+        self._cur["alive"][:] = alive & (self._cur["health"] > 0)
+        self._bind()
+        return found
+
+    def prev(self, name):
+        """Values of field name at the previous step."""
+        return self._prev[name]
+
+    def _write(self, slot, unit):
+        cur = self._cur
+        cur["tag"][slot] = unit.tag
+        cur["unit_type"][slot] = unit.unit_type
+        cur["x"][slot] = unit.pos.x
+        cur["y"][slot] = unit.pos.y
+        cur["health"][slot] = unit.health
+        cur["health_max"][slot] = unit.health_max
+        cur["shield"][slot] = unit.shield
+        cur["shield_max"][slot] = unit.shield_max
+        cur["energy"][slot] = unit.energy
+        cur["energy_max"][slot] = unit.energy_max
+        cur["weapon_cooldown"][slot] = unit.weapon_cooldown
+        cur["is_flying"][slot] = unit.is_flying
+
+    def _bind(self):
+        # expose the current buffer as attributes, e.g. table.health
+        for name, _ in self.FIELDS:
+            setattr(self, name, self._cur[name])
@@ -3,6 +3,7 @@ from components.episode_buffer import EpisodeBatch
 from modules.mixers.vdn import VDNMixer
 from modules.mixers.qmix import QMixer
 from modules.mixers.flex_qmix import FlexQMixer, LinearFlexQMixer
+from modules.layers import EpisodeMasks
 import torch as th
 from torch.optim import RMSprop
 import numpy as np
@@ -61,12 +62,15 @@ class QLearner:
                 entities.append(last_actions)
 
             entities = th.cat(entities, dim=3)
+            active_mask = batch.masks.active
             return ((entities[:, :-1].repeat(repeat_batch, 1, 1, 1),
-                     batch["entity_mask"][:, :-1].repeat(repeat_batch, 1, 1)),
+                     batch["entity_mask"][:, :-1].repeat(repeat_batch, 1, 1),
+                     active_mask[:, :-1].repeat(repeat_batch, 1, 1, 1)),
                     (entities[:, 1:],
-                     batch["entity_mask"][:, 1:]))
+                     batch["entity_mask"][:, 1:],
+                     active_mask[:, 1:]))
 
-    def train(self, batch: EpisodeBatch, t_env: int, episode_num: int):
+    def train(self, batch: EpisodeBatch, t_env: int, episode_num: int, per_weight=None):
         # Get the relevant quantities
         rewards = batch["reward"][:, :-1]
         actions = batch["actions"][:, :-1]
@@ -74,6 +78,9 @@ class QLearner:
         mask = batch["filled"][:, :-1].float()
         mask[:, 1:] = mask[:, 1:] * (1 - terminated[:, :-1])
         avail_actions = batch["avail_actions"]
+        if self.args.entity_scheme:
+            # attention masks built once and shared by the mac, target mac and mixers below
+            batch.masks = EpisodeMasks(batch["obs_mask"], batch["entity_mask"], self.args.n_agents)
 
         will_log = (t_env - self.log_stats_t >= self.args.learner_log_interval)
 
@@ -164,14 +171,22 @@ class QLearner:
         mask = mask.expand_as(td_error)
         # 0-out the targets that came from padded data
         masked_td_error = td_error * mask
-        # Normal L2 loss, take mean over actual data
-        loss = (masked_td_error ** 2).sum() / mask.sum()
+        if per_weight is not None:
+            # importance sampling correction for prioritized replay
+            per_weight = per_weight.view(-1, 1, 1)
+            loss = ((masked_td_error ** 2) * per_weight).sum() / mask.sum()
+        else:
+            # Normal L2 loss, take mean over actual data
+            loss = (masked_td_error ** 2).sum() / mask.sum()
 
         if 'imagine' in self.args.agent:
             im_prop = self.args.lmbda
             im_td_error = (caq_imagine - targets.detach())
             im_masked_td_error = im_td_error * mask
-            im_loss = (im_masked_td_error ** 2).sum() / mask.sum()
+            if per_weight is not None:
+                im_loss = ((im_masked_td_error ** 2) * per_weight).sum() / mask.sum()
+            else:
+                im_loss = (im_masked_td_error ** 2).sum() / mask.sum()
             loss = (1 - im_prop) * loss + im_prop * im_loss
 
         # Optimise
@@ -204,6 +219,11 @@ class QLearner:
                 self.logger.log_stat("max_qtot", max_qtots.mean().item(), t_env)
             self.log_stats_t = t_env
 
+        if self.args.buffer_use_per:
+            # mean absolute TD error per episode, used as its new replay priority
+            td_error_ep = masked_td_error.abs().sum(dim=(1, 2)) / mask.sum(dim=(1, 2)).clamp(min=1)
+            return td_error_ep.detach().cpu().numpy()
+
     def _update_targets(self):
         self.target_mac.load_state(self.mac)
         if self.mixer is not None:
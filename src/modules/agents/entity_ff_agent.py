@@ -1,7 +1,7 @@
 import torch as th
 import torch.nn as nn
 import torch.nn.functional as F
-from ..layers import EntityAttentionLayer, EntityPoolingLayer
+from ..layers import EntityAttentionLayer, EntityPoolingLayer, entitymask2attnmask, group_attnmasks, random_groups
 
 
 class EntityAttentionFFAgent(nn.Module):
@@ -61,22 +61,6 @@ class ImagineEntityAttentionFFAgent(EntityAttentionFFAgent):
     def __init__(self, *args, **kwargs):
         super(ImagineEntityAttentionFFAgent, self).__init__(*args, **kwargs)
 
-    def logical_not(self, inp):
-        return 1 - inp
-
-    def logical_or(self, inp1, inp2):
-        out = inp1 + inp2
-        out[out > 1] = 1
-        return out
-
-    def entitymask2attnmask(self, entity_mask):
-        bs, ts, ne = entity_mask.shape
-        agent_mask = entity_mask[:, :, :self.args.n_agents]
-        in1 = (1 - agent_mask.to(th.float)).reshape(bs * ts, self.args.n_agents, 1)
-        in2 = (1 - entity_mask.to(th.float)).reshape(bs * ts, 1, ne)
-        attn_mask = 1 - th.bmm(in1, in2)
-        return attn_mask.reshape(bs, ts, self.args.n_agents, ne).to(th.uint8)
-
     def forward(self, inputs, hidden_state, imagine=False, use_gt_factors=False, use_rand_gt_factors=False):
         if not imagine:
             return super(ImagineEntityAttentionFFAgent, self).forward(inputs, hidden_state)
@@ -86,40 +70,27 @@ class ImagineEntityAttentionFFAgent(EntityAttentionFFAgent):
             entities, obs_mask, entity_mask, gt_mask = inputs
         bs, ts, ne, ed = entities.shape
 
-        # create random split of entities (once per episode)
-        groupA_probs = th.rand(bs, 1, 1, device=entities.device).repeat(1, 1, ne)
-
-        activeattnmask = self.entitymask2attnmask(entity_mask[:, [0]])
+        n_agents = self.args.n_agents
         if use_gt_factors:
-            withinattnmask = gt_mask
-            interactattnmask = self.logical_not(withinattnmask)
+            withinattnmask = gt_mask.bool()
+            interactattnmask = ~withinattnmask
+            activeattnmask = entitymask2attnmask(entity_mask[:, [0]], n_queries=n_agents)
         else:
-            groupA = th.bernoulli(groupA_probs).to(th.uint8)
-            groupB = self.logical_not(groupA)
-            # mask out entities not present in env
-            groupA = self.logical_or(groupA, entity_mask[:, [0]])
-            groupB = self.logical_or(groupB, entity_mask[:, [0]])
-
-            # convert entity mask to attention mask
-            groupAattnmask = self.entitymask2attnmask(groupA)
-            groupBattnmask = self.entitymask2attnmask(groupB)
-            # create attention mask for interactions between groups
-            interactattnmask = self.logical_or(self.logical_not(groupAattnmask),
-                                               self.logical_not(groupBattnmask))
-            # get within group attention mask
-            withinattnmask = self.logical_not(interactattnmask)
+            # create random split of entities (once per episode), masks are built at ts=1
+            withinattnmask, interactattnmask, activeattnmask = group_attnmasks(
+                random_groups(entity_mask), entity_mask, n_queries=n_agents)
         if use_rand_gt_factors:
             assert not use_gt_factors, "Can only select one of use_rand_gt_factors and use_gt_factors"
-            withinattnmask = self.logical_or(withinattnmask, gt_mask)
-            interactattnmask = self.logical_not(withinattnmask)
-
+            withinattnmask = withinattnmask | gt_mask.bool()
+            interactattnmask = ~withinattnmask
 
         # get masks to use for mixer (no obs_mask but mask out unused entities)
-        Wattnmask_noobs = self.logical_or(withinattnmask, activeattnmask)
-        Iattnmask_noobs = self.logical_or(interactattnmask, activeattnmask)
+        Wattnmask_noobs = withinattnmask | activeattnmask
+        Iattnmask_noobs = interactattnmask | activeattnmask
         # mask out agents that aren't observable (also expands time dim due to shape of obs_mask)
-        withinattnmask = self.logical_or(withinattnmask, obs_mask)
-        interactattnmask = self.logical_or(interactattnmask, obs_mask)
+        obs_mask = obs_mask.bool()
+        withinattnmask = withinattnmask | obs_mask
+        interactattnmask = interactattnmask | obs_mask
 
         entities = entities.repeat(3, 1, 1, 1)
         obs_mask = th.cat([obs_mask, withinattnmask, interactattnmask], dim=0)
@@ -128,8 +99,5 @@ class ImagineEntityAttentionFFAgent(EntityAttentionFFAgent):
         inputs = (entities, obs_mask, entity_mask)
         hidden_state = hidden_state.repeat(3, 1, 1)
         q, h = super(ImagineEntityAttentionFFAgent, self).forward(inputs, hidden_state)
-        if use_gt_factors or use_rand_gt_factors:
-            rep_t = 1
-        else:
-            rep_t = ts
-        return q, h, (Wattnmask_noobs.repeat(1, rep_t, 1, 1), Iattnmask_noobs.repeat(1, rep_t, 1, 1))
+        # random group masks are per episode, gt masks already have a time dim
+        return q, h, (Wattnmask_noobs.expand(-1, ts, -1, -1), Iattnmask_noobs.expand(-1, ts, -1, -1))
@@ -1,7 +1,7 @@
 import torch as th
 import torch.nn as nn
 import torch.nn.functional as F
-from modules.layers import EntityAttentionLayer, EntityPoolingLayer
+from modules.layers import EntityAttentionLayer, EntityPoolingLayer, group_attnmasks, random_groups, gru_unroll
 import numpy as np
 
 class EntityAttentionRNNAgent(nn.Module):
@@ -29,10 +29,16 @@ class EntityAttentionRNNAgent(nn.Module):
         return self.fc1.weight.new(1, self.args.rnn_hidden_dim).zero_()
 
     def forward(self, inputs, hidden_state, ret_attn_logits=None):
+        """
+        obs_mask may have a leading mask dimension (n_masks, bs, ts, ne, ne). Entities are then
+        embedded and projected once and attended with every mask, and everything after the
+        attention (hidden_state included) has batch size n_masks * bs, mask-major.
+        """
         entities, obs_mask, entity_mask = inputs
         bs, ts, ne, ed = entities.shape
+        n_masks = obs_mask.shape[0] if obs_mask.dim() == 5 else 1
         entities = entities.reshape(bs * ts, ne, ed)
-        obs_mask = obs_mask.reshape(bs * ts, ne, ne)
+        obs_mask = obs_mask.reshape(*obs_mask.shape[:-4], bs * ts, ne, ne)
         entity_mask = entity_mask.reshape(bs * ts, ne)
         agent_mask = entity_mask[:, :self.args.n_agents]
         x1 = F.relu(self.fc1(entities))
@@ -43,16 +49,21 @@ class EntityAttentionRNNAgent(nn.Module):
             x2, attn_logits = attn_outs
         else:
             x2 = attn_outs
+        bs = n_masks * bs
+        agent_mask = agent_mask.repeat(n_masks, 1)
         x3 = F.relu(self.fc2(x2))
         x3 = x3.reshape(bs, ts, self.args.n_agents, -1)
 
         h = hidden_state.reshape(-1, self.args.rnn_hidden_dim)
-        hs = []
-        for t in range(ts):
-            curr_x3 = x3[:, t].reshape(-1, self.args.rnn_hidden_dim)
-            h = self.rnn(curr_x3, h)
-            hs.append(h.reshape(bs, self.args.n_agents, self.args.rnn_hidden_dim))
-        hs = th.stack(hs, dim=1)  # Concat over time
+        if ts == 1:
+            h = self.rnn(x3.reshape(-1, self.args.rnn_hidden_dim), h)
+            hs = h.reshape(bs, 1, self.args.n_agents, self.args.rnn_hidden_dim)
+        else:
+            # unroll the whole sequence at once (training passes)
+            x3 = x3.transpose(0, 1).reshape(ts, bs * self.args.n_agents, -1)
+            hs = gru_unroll(self.rnn, x3, h)
+            h = hs[-1]
+            hs = hs.reshape(ts, bs, self.args.n_agents, -1).transpose(0, 1)
 
         q = self.fc3(hs)
         # zero out output for inactive agents
@@ -60,156 +71,76 @@ class EntityAttentionRNNAgent(nn.Module):
         q = q.masked_fill(agent_mask.reshape(bs, ts, self.args.n_agents, 1), 0)
         # q = q.reshape(bs * self.args.n_agents, -1)
         if ret_attn_logits is not None:
-            return q, h, attn_logits.reshape(bs, ts, self.args.n_agents, ne)
+            return q, h, attn_logits.reshape(-1, ts, self.args.n_agents, ne)
         return q, hs
 
 class ImagineEntityAttentionRNNAgent(EntityAttentionRNNAgent):
     def __init__(self, *args, **kwargs):
         super(ImagineEntityAttentionRNNAgent, self).__init__(*args, **kwargs)
 
-    def logical_not(self, inp):
-        return 1 - inp
-
-    def logical_or(self, inp1, inp2):
-        out = inp1 + inp2
-        out[out > 1] = 1
-        return out
-
-    def entitymask2attnmask(self, entity_mask):
-        bs, ts, ne = entity_mask.shape
-        # agent_mask = entity_mask[:, :, :self.args.n_agents]
-        in1 = (1 - entity_mask.to(th.float)).reshape(bs * ts, ne, 1)
-        in2 = (1 - entity_mask.to(th.float)).reshape(bs * ts, 1, ne)
-        attn_mask = 1 - th.bmm(in1, in2)
-        return attn_mask.reshape(bs, ts, ne, ne).to(th.uint8)
-
     def forward(self, inputs, hidden_state, imagine=False, **kwargs):
         if not imagine:
             return super(ImagineEntityAttentionRNNAgent, self).forward(inputs, hidden_state)
         entities, obs_mask, entity_mask = inputs
         bs, ts, ne, ed = entities.shape
 
-        # create random split of entities (once per episode)
-        groupA_probs = th.rand(bs, 1, 1, device=entities.device).repeat(1, 1, ne)
-
-        groupA = th.bernoulli(groupA_probs).to(th.uint8)
-        groupB = self.logical_not(groupA)
-        # mask out entities not present in env
-        groupA = self.logical_or(groupA, entity_mask[:, [0]])
-        groupB = self.logical_or(groupB, entity_mask[:, [0]])
-
-        # convert entity mask to attention mask
-        groupAattnmask = self.entitymask2attnmask(groupA)
-        groupBattnmask = self.entitymask2attnmask(groupB)
-        # create attention mask for interactions between groups
-        interactattnmask = self.logical_or(self.logical_not(groupAattnmask),
-                                           self.logical_not(groupBattnmask))
-        # get within group attention mask
-        withinattnmask = self.logical_not(interactattnmask)
-
-        activeattnmask = self.entitymask2attnmask(entity_mask[:, [0]])
+        # create random split of entities (once per episode), masks are built at ts=1
+        withinattnmask, interactattnmask, activeattnmask = group_attnmasks(
+            random_groups(entity_mask), entity_mask)
         # get masks to use for mixer (no obs_mask but mask out unused entities)
-        Wattnmask_noobs = self.logical_or(withinattnmask, activeattnmask)
-        Iattnmask_noobs = self.logical_or(interactattnmask, activeattnmask)
+        Wattnmask_noobs = withinattnmask | activeattnmask
+        Iattnmask_noobs = interactattnmask | activeattnmask
         # mask out agents that aren't observable (also expands time dim due to shape of obs_mask)
-        withinattnmask = self.logical_or(withinattnmask, obs_mask)
-        interactattnmask = self.logical_or(interactattnmask, obs_mask)
+        obs_mask = obs_mask.bool()
+        withinattnmask = withinattnmask | obs_mask
+        interactattnmask = interactattnmask | obs_mask
 
-        entities = entities.repeat(3, 1, 1, 1)
-        obs_mask = th.cat([obs_mask, withinattnmask, interactattnmask], dim=0)
-        entity_mask = entity_mask.repeat(3, 1, 1)
+        # real, within and interact branches share the entity embedding and projections
+        obs_mask = th.stack([obs_mask, withinattnmask, interactattnmask], dim=0)
 
         inputs = (entities, obs_mask, entity_mask)
         hidden_state = hidden_state.repeat(3, 1, 1)
         q, h = super(ImagineEntityAttentionRNNAgent, self).forward(inputs, hidden_state)
-        return q, h, (Wattnmask_noobs.repeat(1, ts, 1, 1), Iattnmask_noobs.repeat(1, ts, 1, 1))
+        return q, h, (Wattnmask_noobs.expand(-1, ts, -1, -1), Iattnmask_noobs.expand(-1, ts, -1, -1))
 
 
 class ImagineEntityAttentionRNNAgentDrop(EntityAttentionRNNAgent):
     def __init__(self, *args, **kwargs):
         super(ImagineEntityAttentionRNNAgentDrop, self).__init__(*args, **kwargs)
 
-    def logical_not(self, inp):
-        return 1 - inp
-
-    def logical_or(self, inp1, inp2):
-        out = inp1 + inp2
-        out[out > 1] = 1
-        return out
-
-    def entitymask2attnmask(self, entity_mask):
-        bs, ts, ne = entity_mask.shape
-        # agent_mask = entity_mask[:, :, :self.args.n_agents]
-        in1 = (1 - entity_mask.to(th.float)).reshape(bs * ts, ne, 1)
-        in2 = (1 - entity_mask.to(th.float)).reshape(bs * ts, 1, ne)
-        attn_mask = 1 - th.bmm(in1, in2)
-        return attn_mask.reshape(bs, ts, ne, ne).to(th.uint8)
-
     def forward(self, inputs, hidden_state, imagine=False, **kwargs):
         if not imagine:
             return super(ImagineEntityAttentionRNNAgentDrop, self).forward(inputs, hidden_state)
         entities, obs_mask, entity_mask = inputs
         bs, ts, ne, ed = entities.shape
 
-        # create random split of entities (once per episode)
-        groupA_probs = th.rand(bs, 1, 1, device=entities.device).repeat(1, 1, ne)
-
-        groupA = th.bernoulli(groupA_probs).to(th.uint8)
-        groupB = self.logical_not(groupA)
-        # mask out entities not present in env
-        groupA = self.logical_or(groupA, entity_mask[:, [0]])
-        groupB = self.logical_or(groupB, entity_mask[:, [0]])
-
-        # convert entity mask to attention mask
-        groupAattnmask = self.entitymask2attnmask(groupA)
-        groupBattnmask = self.entitymask2attnmask(groupB)
-        # create attention mask for interactions between groups
-        interactattnmask = self.logical_or(self.logical_not(groupAattnmask),
-                                           self.logical_not(groupBattnmask))
-        # get within group attention mask
-        withinattnmask = self.logical_not(interactattnmask)
-
-        activeattnmask = self.entitymask2attnmask(entity_mask[:, [0]])
+        # create random split of entities (once per episode), masks are built at ts=1
+        withinattnmask, interactattnmask, activeattnmask = group_attnmasks(
+            random_groups(entity_mask), entity_mask)
         # get masks to use for mixer (no obs_mask but mask out unused entities)
-        Wattnmask_noobs = self.logical_or(withinattnmask, activeattnmask)
-        Iattnmask_noobs = self.logical_or(interactattnmask, activeattnmask)
+        Wattnmask_noobs = withinattnmask | activeattnmask
+        Iattnmask_noobs = interactattnmask | activeattnmask
         # mask out agents that aren't observable (also expands time dim due to shape of obs_mask)
-        withinattnmask = self.logical_or(withinattnmask, obs_mask)
-        interactattnmask = self.logical_or(interactattnmask, obs_mask)
+        obs_mask = obs_mask.bool()
+        withinattnmask = withinattnmask | obs_mask
+        interactattnmask = interactattnmask | obs_mask
 
         # drop_loss --
         if self.args.drop_fix:
-            drop_probs = self.args.drop_rate * th.ones(bs, ts, 1, 1, device=entities.device).repeat(1, 1, ne, ne)
-            ndrop_obs = th.bernoulli(drop_probs).to(th.uint8)
-            drop_attnmask = self.logical_or(ndrop_obs, obs_mask)
-            drop_attnmask_noobs = self.logical_or(ndrop_obs, activeattnmask)
+            drop_probs = self.args.drop_rate * th.ones(bs, ts, 1, 1, device=entities.device).expand(bs, ts, ne, ne)
+            ndrop_obs = th.bernoulli(drop_probs).bool()
+            drop_attnmask = ndrop_obs | obs_mask
+            drop_attnmask_noobs = ndrop_obs | activeattnmask
         else:
-            drop_probs = th.rand(bs, 1, 1, device=entities.device).repeat(1, 1, ne)
-            drop_groupA = th.bernoulli(drop_probs).to(th.uint8)
-            drop_groupB = self.logical_not(drop_groupA)
-            # mask out entities not present in env
-            drop_groupA = self.logical_or(drop_groupA, entity_mask[:, [0]])
-            drop_groupB = self.logical_or(drop_groupB, entity_mask[:, [0]])
-
-            # convert entity mask to attention mask
-            drop_groupAattnmask = self.entitymask2attnmask(drop_groupA)
-            drop_groupBattnmask = self.entitymask2attnmask(drop_groupB)
-            # create attention mask for interactions between groups
-            drop_interactattnmask = self.logical_or(self.logical_not(drop_groupAattnmask),
-                                               self.logical_not(drop_groupBattnmask))
-            # get within group attention mask
-            drop_withinattnmask = self.logical_not(drop_interactattnmask)
-            drop_attnmask_noobs = self.logical_or(drop_withinattnmask, activeattnmask).repeat(1, ts, 1, 1)
-            drop_attnmask = self.logical_or(drop_withinattnmask, obs_mask)
-
-
-
+            drop_withinattnmask, _, _ = group_attnmasks(random_groups(entity_mask), entity_mask)
+            drop_attnmask_noobs = (drop_withinattnmask | activeattnmask).expand(-1, ts, -1, -1)
+            drop_attnmask = drop_withinattnmask | obs_mask
 
-        entities = entities.repeat(4, 1, 1, 1)
-        obs_mask = th.cat([obs_mask, withinattnmask, interactattnmask, drop_attnmask], dim=0)
-        entity_mask = entity_mask.repeat(4, 1, 1)
+        # real, within, interact and drop branches share the entity embedding and projections
+        obs_mask = th.stack([obs_mask, withinattnmask, interactattnmask, drop_attnmask], dim=0)
 
         inputs = (entities, obs_mask, entity_mask)
         hidden_state = hidden_state.repeat(4, 1, 1)
         q, h = super(ImagineEntityAttentionRNNAgentDrop, self).forward(inputs, hidden_state)
-        return q, h, (Wattnmask_noobs.repeat(1, ts, 1, 1), Iattnmask_noobs.repeat(1, ts, 1, 1), drop_attnmask_noobs)
\ No newline at end of file
+        return q, h, (Wattnmask_noobs.expand(-1, ts, -1, -1), Iattnmask_noobs.expand(-1, ts, -1, -1),
+                      drop_attnmask_noobs)
\ No newline at end of file
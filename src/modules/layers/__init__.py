@@ -1 +1,3 @@
 from .attention import EntityAttentionLayer, EntityPoolingLayer
+from .masks import entitymask2attnmask, group_attnmasks, random_groups, EpisodeMasks
+from .gru import gru_unroll
@@ -12,6 +12,11 @@ class EntityAttentionLayer(nn.Module):
         self.n_heads = args.attn_n_heads
         self.n_agents = args.n_agents
         self.args = args
+        # "bmm": explicit logits and softmax, "sdpa": th.nn.functional.scaled_dot_product_attention
+        self.backend = getattr(args, "attn_backend", "bmm")
+        assert self.backend in ("bmm", "sdpa"), "Unknown attention backend {}".format(self.backend)
+        assert self.backend != "sdpa" or hasattr(F, "scaled_dot_product_attention"), \
+            "sdpa attention backend needs torch >= 2.0"
 
         assert self.embed_dim % self.n_heads == 0, "Embed dim must be divisible by n_heads"
         self.head_dim = self.embed_dim // self.n_heads
@@ -26,8 +31,9 @@ class EntityAttentionLayer(nn.Module):
         entities: Entity representations
             shape: batch size, # of entities, embedding dimension
         pre_mask: Which agent-entity pairs are not available (observability and/or padding).
-                  Mask out before attention.
-            shape: batch_size, # of agents, # of entities
+                  Mask out before attention. A leading mask dimension runs attention once per
+                  mask over the same projected entities, outputs are stacked mask-major.
+            shape: [# of masks,] batch_size, # of agents, # of entities
         post_mask: Which agents/entities are not available. Zero out their outputs to
                    prevent gradients from flowing back. Shape of 2nd dim determines
                    whether to compute queries for all entities or just agents.
@@ -36,35 +42,45 @@ class EntityAttentionLayer(nn.Module):
             None: do not return
             "max": take max over heads
             "mean": take mean over heads
+            (the sdpa backend does not expose logits, the bmm path is used when requested)
 
-        Return shape: batch size, # of agents, embedding dimension
+        Return shape: [# of masks *] batch size, # of agents, embedding dimension
         """
         entities_t = entities.transpose(0, 1)
         n_queries = post_mask.shape[1]
-        pre_mask = pre_mask[:, :n_queries]
+        n_masks = pre_mask.shape[0] if pre_mask.dim() == 4 else 1
+        pre_mask = pre_mask[..., :n_queries, :]
         ne, bs, ed = entities_t.shape
         query, key, value = self.in_trans(entities_t).chunk(3, dim=2)
 
         query = query[:n_queries]
 
+        if self.backend == "sdpa" and ret_attn_logits is None:
+            attn_outs = self._sdpa(query, key, value, pre_mask, n_masks)
+            attn_outs = self.out_trans(attn_outs)
+            if post_mask is not None:
+                attn_outs = attn_outs.masked_fill(post_mask.repeat(n_masks, 1).unsqueeze(2), 0)
+            return attn_outs
+
         query_spl = query.reshape(n_queries, bs * self.n_heads, self.head_dim).transpose(0, 1)
         key_spl = key.reshape(ne, bs * self.n_heads, self.head_dim).permute(1, 2, 0)
         value_spl = value.reshape(ne, bs * self.n_heads, self.head_dim).transpose(0, 1)
 
         attn_logits = th.bmm(query_spl, key_spl) / self.scale_factor
         if pre_mask is not None:
-            pre_mask_rep = pre_mask.repeat_interleave(self.n_heads, dim=0)
-            masked_attn_logits = attn_logits.masked_fill(pre_mask_rep[:, :, :ne], -float('Inf'))
-        attn_weights = F.softmax(masked_attn_logits, dim=2)
+            # logits broadcast over the mask dimension, if any
+            pre_mask_rep = pre_mask.repeat_interleave(self.n_heads, dim=-3)
+            masked_attn_logits = attn_logits.masked_fill(pre_mask_rep[..., :ne], -float('Inf'))
+        attn_weights = F.softmax(masked_attn_logits, dim=-1)
         # some weights might be NaN (if agent is inactive and all entities were masked)
         attn_weights = attn_weights.masked_fill(attn_weights != attn_weights, 0)
-        attn_outs = th.bmm(attn_weights, value_spl)
-        attn_outs = attn_outs.transpose(
-            0, 1).reshape(n_queries, bs, self.embed_dim)
-        attn_outs = attn_outs.transpose(0, 1)
+        attn_outs = th.matmul(attn_weights, value_spl)
+        # [n_masks,] bs * n_heads, nq, head_dim -> n_masks * bs, nq, embed_dim
+        attn_outs = attn_outs.reshape(n_masks, bs, self.n_heads, n_queries, self.head_dim)
+        attn_outs = attn_outs.transpose(2, 3).reshape(n_masks * bs, n_queries, self.embed_dim)
         attn_outs = self.out_trans(attn_outs)
         if post_mask is not None:
-            attn_outs = attn_outs.masked_fill(post_mask.unsqueeze(2), 0)
+            attn_outs = attn_outs.masked_fill(post_mask.repeat(n_masks, 1).unsqueeze(2), 0)
         if ret_attn_logits is not None:
             # bs * n_heads, nq, ne
             attn_logits = attn_logits.reshape(bs, self.n_heads,
@@ -78,6 +94,35 @@ class EntityAttentionLayer(nn.Module):
             return attn_outs, attn_logits
         return attn_outs
 
+    def _sdpa(self, query, key, value, pre_mask, n_masks):
+        """
+        query: n_queries, bs, embed_dim; key, value: ne, bs, embed_dim
+        pre_mask: [n_masks,] bs, n_queries, ne (nonzero = masked out)
+        Returns n_masks * bs, n_queries, embed_dim
+        """
+        nq, bs, _ = query.shape
+        ne = key.shape[0]
+        # bs, n_heads, tokens, head_dim
+        query, key, value = [x.reshape(x.shape[0], bs, self.n_heads, self.head_dim).permute(1, 2, 0, 3)
+                             for x in (query, key, value)]
+        # boolean "may attend" mask, broadcast over heads instead of repeated per head
+        allowed = (pre_mask[..., :ne] == 0).unsqueeze(-3)
+        # queries that may not attend to anything would give NaN, let them attend everywhere
+        # and zero their outputs afterwards (same as the bmm path)
+        empty = ~allowed.any(dim=-1, keepdim=True)
+        allowed = allowed | empty
+        if pre_mask.dim() == 4:
+            # stack the masks along the query axis so keys/values are shared, not expanded
+            # n_masks, bs, 1, nq, ne -> bs, 1, n_masks * nq, ne
+            allowed = allowed.permute(1, 2, 0, 3, 4).reshape(bs, 1, n_masks * nq, ne)
+            empty = empty.permute(1, 2, 0, 3, 4).reshape(bs, 1, n_masks * nq, 1)
+            query = query.repeat(1, 1, n_masks, 1)
+        attn_outs = F.scaled_dot_product_attention(query, key, value, attn_mask=allowed)
+        attn_outs = attn_outs.masked_fill(empty, 0)
+        # bs, n_heads, n_masks * nq, head_dim -> n_masks * bs, nq, embed_dim
+        attn_outs = attn_outs.reshape(bs, self.n_heads, n_masks, nq, self.head_dim)
+        return attn_outs.permute(2, 0, 3, 1, 4).reshape(n_masks * bs, nq, self.embed_dim)
+
 
 class EntityPoolingLayer(nn.Module):
     def __init__(self, in_dim, embed_dim, out_dim, pooling_type, args):
@@ -97,42 +142,78 @@ class EntityPoolingLayer(nn.Module):
         entities: Entity representations
             shape: batch size, # of entities, embedding dimension
         pre_mask: Which agent-entity pairs are not available (observability and/or padding).
-                  Mask out before pooling.
-            shape: batch_size, # of agents, # of entities
+                  Mask out before pooling. A leading mask dimension pools once per mask,
+                  outputs are stacked mask-major.
+            shape: [# of masks,] batch_size, # of agents, # of entities
         post_mask: Which agents are not available. Zero out their outputs to
                    prevent gradients from flowing back.
             shape: batch size, # of agents
         ret_attn_logits: not used, here to match attention layer args
 
-        Return shape: batch size, # of agents, embedding dimension
+        Return shape: [# of masks *] batch size, # of agents, embedding dimension
         """
         bs, ne, ed = entities.shape
 
         ents_trans = self.in_trans(entities)
         n_queries = post_mask.shape[1]
-        pre_mask = pre_mask[:, :n_queries]
+        n_masks = pre_mask.shape[0] if pre_mask.dim() == 4 else 1
+        pre_mask = pre_mask[..., :n_queries, :]
         # duplicate all entities per agent so we can mask separately
         ents_trans_rep = ents_trans.reshape(bs, 1, ne, ed).repeat(1, self.n_agents, 1, 1)
 
         if pre_mask is not None:
-            ents_trans_rep = ents_trans_rep.masked_fill(pre_mask.unsqueeze(3), 0)
+            ents_trans_rep = ents_trans_rep.masked_fill(pre_mask.unsqueeze(-1), 0)
 
         if self.pooling_type == 'max':
-            pool_outs = ents_trans_rep.max(dim=2)[0]
+            pool_outs = ents_trans_rep.max(dim=-2)[0]
         elif self.pooling_type == 'mean':
-            pool_outs = ents_trans_rep.mean(dim=2)
+            pool_outs = ents_trans_rep.mean(dim=-2)
 
-        pool_outs = self.out_trans(pool_outs)
+        pool_outs = self.out_trans(pool_outs.reshape(n_masks * bs, self.n_agents, -1))
 
         if post_mask is not None:
-            pool_outs = pool_outs.masked_fill(post_mask.unsqueeze(2), 0)
+            pool_outs = pool_outs.masked_fill(post_mask.repeat(n_masks, 1).unsqueeze(2), 0)
 
         if ret_attn_logits is not None:
             return pool_outs, None
         return pool_outs
 
 
-
-
-
-
+if __name__ == "__main__":
+    # CPU benchmark of the attention backends (forward + backward) at agent and mixer shapes,
+    # run from src with: python -m modules.layers.attention
+    import timeit
+    from types import SimpleNamespace
+    from modules.mixers.flex_qmix import AttentionHyperNet
+
+    th.manual_seed(0)
+    n_agents, n_entities, entity_shape, n_actions, reps = 8, 16, 32, 20, 20
+    # agent batches are bs * ts (32 episodes x 60 steps)
+    bs = 32 * 60
+    post_mask = th.zeros(bs, n_agents, dtype=th.bool)
+    for name, n_masks in (("agent", 1), ("agent x4 masks", 4), ("mixer hypernet", 1)):
+        times = {}
+        for backend in ("bmm", "sdpa"):
+            args = SimpleNamespace(attn_n_heads=4, n_agents=n_agents, attn_backend=backend, entity_shape=entity_shape,
+                                   entity_last_action=True, n_actions=n_actions, hypernet_embed=128,
+                                   mixing_embed_dim=32, pooling_type=None)
+            th.manual_seed(1)
+            if name == "mixer hypernet":
+                # first-layer mixing weights from entities and the mask of inactive entities
+                hypernet = AttentionHyperNet(args, mode='matrix')
+                entities = th.randn(bs, n_entities, entity_shape + n_actions, requires_grad=True)
+                entity_mask = th.rand(bs, n_entities) < 0.2
+
+                def run():
+                    hypernet(entities, entity_mask).sum().backward()
+            else:
+                layer = EntityAttentionLayer(128, 128, 128, args)
+                entities = th.randn(bs, n_entities, 128, requires_grad=True)
+                pre_mask = th.rand(n_masks, bs, n_entities, n_entities) < 0.4
+                pre_mask = pre_mask[0] if n_masks == 1 else pre_mask
+
+                def run():
+                    layer(entities, pre_mask=pre_mask, post_mask=post_mask).sum().backward()
+            run()
+            times[backend] = timeit.timeit(run, number=reps) / reps
+        print("{:15s} bmm {:7.1f}ms  sdpa {:7.1f}ms".format(name, times["bmm"] * 1e3, times["sdpa"] * 1e3))
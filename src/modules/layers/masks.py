@@ -0,0 +1,88 @@
+import torch as th
+
+
+def entitymask2attnmask(entity_mask, n_queries=None):
+    """
+    entity_mask: Which entities are not present (nonzero = absent)
+        shape: ..., # of entities
+    n_queries: Only build rows for the first n_queries entities (e.g. the agents)
+
+    Return: bool mask, True where the query or the key entity is absent
+        shape: ..., # of queries, # of entities
+    """
+    entity_mask = entity_mask.bool()
+    queries = entity_mask if n_queries is None else entity_mask[..., :n_queries]
+    return queries.unsqueeze(-1) | entity_mask.unsqueeze(-2)
+
+
+def random_groups(entity_mask):
+    """
+    Draws a random split of entities into two groups, once per episode.
+    entity_mask: bs, ts, # of entities
+
+    Return: bool, True for entities in group A
+        shape: bs, 1, # of entities
+    """
+    bs, _, ne = entity_mask.shape
+    groupA_probs = th.rand(bs, 1, 1, device=entity_mask.device).expand(bs, 1, ne)
+    return th.bernoulli(groupA_probs).bool()
+
+
+def group_attnmasks(groupA, entity_mask, n_queries=None):
+    """
+    Attention masks of a two-group split of entities.
+    groupA: bool, which entities are in group A (the rest are in group B)
+        shape: bs, 1, # of entities
+    entity_mask: Which entities are not present, only the first timestep is used
+        shape: bs, ts, # of entities
+    n_queries: as in entitymask2attnmask
+
+    Return: within, interact, active
+        within: masks out pairs that are not both present and in the same group
+        interact: masks out present pairs within the same group (absent pairs stay open,
+                  matching the masks the mixer was trained with)
+        active: masks out pairs with an absent entity
+        shape: bs, 1, # of queries, # of entities (bool)
+    """
+    present = ~entity_mask[:, [0]].bool()
+    inA = groupA & present
+    inB = ~groupA & present
+    nq = groupA.shape[-1] if n_queries is None else n_queries
+    interact = ((inA[..., :nq].unsqueeze(-1) & inA.unsqueeze(-2)) |
+                (inB[..., :nq].unsqueeze(-1) & inB.unsqueeze(-2)))
+    within = ~interact
+    active = entitymask2attnmask(entity_mask[:, [0]], n_queries=n_queries)
+    return within, interact, active
+
+
+class EpisodeMasks:
+    """
+    Bool attention masks of a sampled batch, built on first use and reused by the mac,
+    target mac and mixers within one train call. The learner attaches one to the batch
+    as batch.masks; the random group masks of the imagine agents are still drawn per
+    forward and handed to the mixer with the agent outputs.
+    obs_mask: Which entity pairs are not observable
+        shape: bs, ts, # of entities, # of entities
+    entity_mask: Which entities are not present
+        shape: bs, ts, # of entities
+    """
+    def __init__(self, obs_mask, entity_mask, n_agents):
+        self._obs_mask = obs_mask
+        self._entity_mask = entity_mask
+        self.n_agents = n_agents
+        self._obs = None
+        self._active = None
+
+    @property
+    def obs(self):
+        """bool obs_mask, shape: bs, ts, # of entities, # of entities"""
+        if self._obs is None:
+            self._obs = self._obs_mask.bool()
+        return self._obs
+
+    @property
+    def active(self):
+        """Mixer attention mask of agents over present entities, shape: bs, ts, # of agents, # of entities"""
+        if self._active is None:
+            self._active = entitymask2attnmask(self._entity_mask, n_queries=self.n_agents)
+        return self._active
@@ -1,7 +1,7 @@
 import torch as th
 import torch.nn as nn
 import torch.nn.functional as F
-from modules.layers import EntityAttentionLayer, EntityPoolingLayer
+from modules.layers import EntityAttentionLayer, EntityPoolingLayer, entitymask2attnmask
 
 
 class AttentionHyperNet(nn.Module):
@@ -42,9 +42,8 @@ class AttentionHyperNet(nn.Module):
         agent_mask = entity_mask[:, :self.args.n_agents]
         if attn_mask is None:
             # create attn_mask from entity mask
-            attn_mask = 1 - th.bmm((1 - agent_mask.to(th.float)).unsqueeze(2),
-                                   (1 - entity_mask.to(th.float)).unsqueeze(1))
-        x2 = self.attn(x1, pre_mask=attn_mask.to(th.uint8),
+            attn_mask = entitymask2attnmask(entity_mask, n_queries=self.args.n_agents)
+        x2 = self.attn(x1, pre_mask=attn_mask.bool(),
                        post_mask=agent_mask)
         x3 = self.fc2(x2)
         x3 = x3.masked_fill(agent_mask.unsqueeze(2), 0)
@@ -77,11 +76,16 @@ class FlexQMixer(nn.Module):
             self.non_lin = F.tanh
 
     def forward(self, agent_qs, inputs, imagine_groups=None):
-        entities, entity_mask = inputs
+        entities, entity_mask = inputs[:2]
         bs, max_t, ne, ed = entities.shape
 
         entities = entities.reshape(bs * max_t, ne, ed)
         entity_mask = entity_mask.reshape(bs * max_t, ne)
+        # attention mask of present entities, shared by all hypernets (precomputed by the learner if given)
+        if len(inputs) > 2:
+            active_mask = inputs[2].reshape(bs * max_t, self.n_agents, ne)
+        else:
+            active_mask = entitymask2attnmask(entity_mask, n_queries=self.n_agents)
         if imagine_groups is not None:
             if not isinstance(imagine_groups, list):
                 agent_qs = agent_qs.view(-1, 1, self.n_agents)
@@ -102,8 +106,8 @@ class FlexQMixer(nn.Module):
         else:
             agent_qs = agent_qs.view(-1, 1, self.n_agents)
             # First layer
-            w1 = self.hyper_w_1(entities, entity_mask)
-        b1 = self.hyper_b_1(entities, entity_mask)
+            w1 = self.hyper_w_1(entities, entity_mask, attn_mask=active_mask)
+        b1 = self.hyper_b_1(entities, entity_mask, attn_mask=active_mask)
         w1 = w1.view(bs * max_t, -1, self.embed_dim)
         b1 = b1.view(-1, 1, self.embed_dim)
         if self.args.softmax_mixing_weights:
@@ -114,12 +118,12 @@ class FlexQMixer(nn.Module):
         hidden = self.non_lin(th.bmm(agent_qs, w1) + b1)
         # Second layer
         if self.args.softmax_mixing_weights:
-            w_final = F.softmax(self.hyper_w_final(entities, entity_mask), dim=-1)
+            w_final = F.softmax(self.hyper_w_final(entities, entity_mask, attn_mask=active_mask), dim=-1)
         else:
-            w_final = th.abs(self.hyper_w_final(entities, entity_mask))
+            w_final = th.abs(self.hyper_w_final(entities, entity_mask, attn_mask=active_mask))
         w_final = w_final.view(-1, self.embed_dim, 1)
         # State-dependent bias
-        v = self.V(entities, entity_mask).view(-1, 1, 1)
+        v = self.V(entities, entity_mask, attn_mask=active_mask).view(-1, 1, 1)
 
         # Compute final output
         y = th.bmm(hidden, w_final) + v
@@ -141,11 +145,16 @@ class LinearFlexQMixer(nn.Module):
         self.V = AttentionHyperNet(args, mode='scalar')
 
     def forward(self, agent_qs, inputs, imagine_groups=None, ret_ingroup_prop=False):
-        entities, entity_mask = inputs
+        entities, entity_mask = inputs[:2]
         bs, max_t, ne, ed = entities.shape
 
         entities = entities.reshape(bs * max_t, ne, ed)
         entity_mask = entity_mask.reshape(bs * max_t, ne)
+        # attention mask of present entities, shared by all hypernets (precomputed by the learner if given)
+        if len(inputs) > 2:
+            active_mask = inputs[2].reshape(bs * max_t, self.n_agents, ne)
+        else:
+            active_mask = entitymask2attnmask(entity_mask, n_queries=self.n_agents)
         if imagine_groups is not None:
             agent_qs = agent_qs.view(-1, self.n_agents * 2)
             Wmask, Imask = imagine_groups
@@ -159,13 +168,13 @@ class LinearFlexQMixer(nn.Module):
         else:
             agent_qs = agent_qs.view(-1, self.n_agents)
             # First layer
-            w1 = self.hyper_w_1(entities, entity_mask)
+            w1 = self.hyper_w_1(entities, entity_mask, attn_mask=active_mask)
         w1 = w1.view(bs * max_t, -1)
         if self.args.softmax_mixing_weights:
             w1 = F.softmax(w1, dim=1)
         else:
             w1 = th.abs(w1)
-        v = self.V(entities, entity_mask)
+        v = self.V(entities, entity_mask, attn_mask=active_mask)
 
         q_cont = agent_qs * w1
         q_tot = q_cont.sum(dim=1) + v
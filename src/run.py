@@ -1,3 +1,5 @@
+import contextlib
+import copy
 import datetime
 from functools import partial
 from math import ceil
@@ -18,7 +20,7 @@ from learners import REGISTRY as le_REGISTRY
 from runners import REGISTRY as r_REGISTRY
 from controllers import REGISTRY as mac_REGISTRY
 from envs import s_REGISTRY
-from components.episode_buffer import ReplayBuffer
+from components.episode_buffer import ReplayBuffer, PrioritizedReplayBuffer, PackedReplayBuffer
 from components.transforms import OneHot
 
 import numpy as np
@@ -210,9 +212,40 @@ def run_sequential(args, logger):
         "actions": ("actions_onehot", [OneHot(out_dim=args.n_actions)])
     }
 
-    buffer = ReplayBuffer(scheme, groups, args.buffer_size, env_info["episode_limit"] + 1,
-                          preprocess=preprocess,
-                          device="cpu" if args.buffer_cpu_only else args.device)
+    buffer_scheme = scheme
+    if args.buffer_packbits:
+        # keep the 0/1 masks bit-packed in the replay buffer, unpacked when sampled
+        buffer_scheme = {k: dict(v) for k, v in scheme.items()}
+        for k in ("obs_mask", "entity_mask", "avail_actions", "gt_mask"):
+            if k in buffer_scheme:
+                buffer_scheme[k]["packbits"] = True
+
+    buffer_storage_dir = None
+    if args.buffer_storage_dir is not None:
+        buffer_storage_dir = os.path.join(args.buffer_storage_dir, args.unique_token)
+    buffer_cpu_only = args.buffer_cpu_only or buffer_storage_dir is not None
+    buffer_device = "cpu" if buffer_cpu_only else args.device
+    pin_memory = buffer_cpu_only and args.use_cuda
+    assert not (args.buffer_use_per and args.buffer_packed), "Prioritized replay is not supported with packed storage"
+    if args.buffer_use_per:
+        buffer = PrioritizedReplayBuffer(buffer_scheme, groups, args.buffer_size, env_info["episode_limit"] + 1,
+                                         alpha=args.per_alpha, beta=args.per_beta, t_max=args.t_max,
+                                         preprocess=preprocess, device=buffer_device, pin_memory=pin_memory,
+                                         storage_dir=buffer_storage_dir, keep_storage=args.buffer_storage_keep)
+    elif args.buffer_packed:
+        transition_capacity = args.buffer_packed_transitions
+        if transition_capacity is None:
+            # budget for episodes averaging half the limit, but always room for one full runner batch
+            transition_capacity = max(args.buffer_size * (env_info["episode_limit"] + 1) // 2,
+                                      args.batch_size_run * (env_info["episode_limit"] + 1))
+        buffer = PackedReplayBuffer(buffer_scheme, groups, args.buffer_size, env_info["episode_limit"] + 1,
+                                    transition_capacity=transition_capacity,
+                                    preprocess=preprocess, device=buffer_device, pin_memory=pin_memory,
+                                    storage_dir=buffer_storage_dir, keep_storage=args.buffer_storage_keep)
+    else:
+        buffer = ReplayBuffer(buffer_scheme, groups, args.buffer_size, env_info["episode_limit"] + 1,
+                              preprocess=preprocess, device=buffer_device, pin_memory=pin_memory,
+                              storage_dir=buffer_storage_dir, keep_storage=args.buffer_storage_keep)
 
 
 
@@ -253,10 +286,26 @@ def run_sequential(args, logger):
         learner.load_models(model_path, evaluate=args.evaluate)
         runner.t_env = timestep_to_load
 
+        if args.buffer_snapshot and not (args.evaluate or args.save_replay):
+            # snapshots live next to the models, i.e. <results>/buffer/<token> for <results>/models/<token>
+            checkpoint_path = os.path.normpath(args.checkpoint_path)
+            snapshot_path = os.path.join(os.path.dirname(os.path.dirname(checkpoint_path)), "buffer",
+                                         os.path.basename(checkpoint_path))
+            if os.path.isfile(os.path.join(snapshot_path, "meta.pkl")):
+                logger.console_logger.info("Loading replay buffer from {}".format(snapshot_path))
+                buffer.load_snapshot(snapshot_path)
+                logger.console_logger.info("Restored {} episodes".format(buffer.episodes_in_buffer))
+            else:
+                logger.console_logger.info("No replay buffer snapshot found in {}".format(snapshot_path))
+
         if args.evaluate or args.save_replay:
             evaluate_sequential(args, runner, logger)
             return
 
+    if args.actor_learner:
+        run_actor_learner(args, logger, runner, buffer, learner, mac)
+        return
+
     # start training
     episode = 0
     last_test_T = -args.test_interval - 1
@@ -276,15 +325,7 @@ def run_sequential(args, logger):
 
         if buffer.can_sample(args.batch_size):
             for _ in range(args.training_iters):
-                episode_sample = buffer.sample(args.batch_size)
-                # Truncate batch to only filled timesteps
-                max_ep_t = episode_sample.max_t_filled()
-                episode_sample = episode_sample[:, :max_ep_t]
-
-                if episode_sample.device != args.device:
-                    episode_sample.to(args.device)
-
-                learner.train(episode_sample, runner.t_env, episode)
+                train_step(args, buffer, learner, runner.t_env, episode)
 
         # Execute test runs once in a while
         n_test_runs = max(1, args.test_nepisode // runner.batch_size)
@@ -306,20 +347,7 @@ def run_sequential(args, logger):
                                 model_save_time == 0 or
                                 runner.t_env > args.t_max):
             model_save_time = runner.t_env
-            save_path = os.path.join(args.local_results_path, "models", args.unique_token, str(runner.t_env))
-            #"results/models/{}".format(unique_token)
-            os.makedirs(save_path, exist_ok=True)
-            logger.console_logger.info("Saving models to {}".format(save_path))
-
-            # learner should handle saving/loading -- delegate actor save/load to mac,
-            # use appropriate filenames to do critics, optimizer states
-            learner.save_models(save_path)
-            bwm_save_path = os.path.join(args.local_results_path, "bwm", args.unique_token)
-            bwm_name = '%s/bwm-%d.pkl' % (bwm_save_path, runner.t_env)
-            os.makedirs(bwm_save_path, exist_ok=True)
-            with open(bwm_name, 'wb') as f:
-                pickle.dump(runner.bwm, f)
-
+            save_checkpoint(args, runner, learner, buffer, logger)
 
         episode += args.batch_size_run
 
@@ -329,6 +357,189 @@ def run_sequential(args, logger):
             last_log_T = runner.t_env
 
     runner.close_env()
+    buffer.close()
+    logger.console_logger.info("Finished Training")
+
+
+def train_step(args, buffer, learner, t_env, episode, buffer_lock=None):
+    # Sample is already truncated to only filled timesteps
+    lock = buffer_lock if buffer_lock is not None else contextlib.nullcontext()
+    if args.buffer_use_per:
+        with lock:
+            episode_sample = buffer.sample(args.batch_size, t_env=t_env, device=args.device)
+        td_errors = learner.train(episode_sample, t_env, episode, per_weight=episode_sample.weights)
+        with lock:
+            buffer.update_priorities(episode_sample.ep_ids, td_errors)
+    else:
+        with lock:
+            episode_sample = buffer.sample(args.batch_size, device=args.device)
+        learner.train(episode_sample, t_env, episode)
+
+
+def save_checkpoint(args, runner, learner, buffer, logger, buffer_lock=None, bwm=None):
+    save_path = os.path.join(args.local_results_path, "models", args.unique_token, str(runner.t_env))
+    #"results/models/{}".format(unique_token)
+    os.makedirs(save_path, exist_ok=True)
+    logger.console_logger.info("Saving models to {}".format(save_path))
+
+    # learner should handle saving/loading -- delegate actor save/load to mac,
+    # use appropriate filenames to do critics, optimizer states
+    learner.save_models(save_path)
+    bwm_save_path = os.path.join(args.local_results_path, "bwm", args.unique_token)
+    bwm_name = '%s/bwm-%d.pkl' % (bwm_save_path, runner.t_env)
+    os.makedirs(bwm_save_path, exist_ok=True)
+    with open(bwm_name, 'wb') as f:
+        pickle.dump(runner.bwm if bwm is None else bwm, f)
+    if args.buffer_snapshot:
+        # one snapshot per run, rewritten incrementally on every save
+        snapshot_path = os.path.join(args.local_results_path, "buffer", args.unique_token)
+        with buffer_lock if buffer_lock is not None else contextlib.nullcontext():
+            n_chunks = buffer.save_snapshot(snapshot_path, chunk_size=args.buffer_snapshot_chunk,
+                                            compress=args.buffer_snapshot_compress)
+        logger.console_logger.info("Saved replay buffer to {} ({} chunks written)".format(snapshot_path, n_chunks))
+
+
+def run_actor_learner(args, logger, runner, buffer, learner, mac):
+    """
+    Collects episodes in a background actor thread while the learner trains continuously.
+    The runner acts with its own copy of the mac, refreshed every actor_sync_interval updates.
+    The learner is held to actor_replay_ratio updates per collected episode, and the actor
+    may run at most actor_max_lead episode batches ahead of that.
+    """
+    replay_ratio = args.actor_replay_ratio
+    if replay_ratio is None:
+        replay_ratio = args.training_iters / args.batch_size_run
+    max_lead = args.actor_max_lead * args.batch_size_run * replay_ratio
+
+    actor_mac = copy.deepcopy(mac)
+    runner.mac = actor_mac
+    buffer_lock = threading.Lock()
+    cond = threading.Condition()
+    # shared between the threads, guarded by cond. The learner is only touched by the learner
+    # thread, test results are handed over in test_logs and applied before the next update.
+    state = SN(episodes=0, first_sampled=None, env_steps=0, updates=0, done=False, error=None,
+               weights=None, weights_version=0, actor_version=0, policy_lag=[], test_logs=None)
+
+    def owed_updates():
+        # like the sequential loop, episodes collected before the buffer could be sampled don't count
+        if state.first_sampled is None:
+            return 0
+        return int(replay_ratio * (state.episodes - state.first_sampled)) - state.updates
+
+    def actor():
+        last_test_T = -args.test_interval - 1
+        start_time = time.time()
+        last_time = start_time
+        try:
+            while runner.t_env <= args.t_max:
+                with cond:
+                    cond.wait_for(lambda: owed_updates() <= max_lead or state.done)
+                    if state.done:
+                        # the learner stopped
+                        break
+                    if state.weights is not None:
+                        actor_mac.agent.load_state_dict(state.weights)
+                        state.actor_version = state.weights_version
+                        state.weights = None
+
+                t_env = runner.t_env
+                episode_batch = runner.run(test_mode=False)
+                with buffer_lock:
+                    buffer.insert_episode_batch(episode_batch)
+                    can_sample = buffer.can_sample(args.batch_size)
+                with cond:
+                    if state.first_sampled is None and can_sample:
+                        state.first_sampled = state.episodes
+                    state.episodes += episode_batch.batch_size
+                    state.env_steps += runner.t_env - t_env
+                    # learner updates the collected episodes are behind by
+                    state.policy_lag.append(state.updates - state.actor_version)
+                    cond.notify_all()
+
+                # Execute test runs once in a while
+                n_test_runs = max(1, args.test_nepisode // runner.batch_size)
+                if (runner.t_env - last_test_T) / args.test_interval >= 1.0:
+                    logger.console_logger.info("t_env: {} / {}".format(runner.t_env, args.t_max))
+                    logger.console_logger.info("Estimated time left: {}. Time passed: {}".format(
+                        time_left(last_time, last_test_T, runner.t_env, args.t_max),
+                        time_str(time.time() - start_time)))
+                    last_time = time.time()
+
+                    last_test_T = runner.t_env
+                    for _ in range(n_test_runs):
+                        runner.run(test_mode=True)
+                    with cond:
+                        state.test_logs = (runner.test_returns_log, np.copy(runner.bwm))
+        except Exception as e:
+            state.error = e
+        finally:
+            with cond:
+                state.done = True
+                cond.notify_all()
+
+    # the actor updates runner.bwm in place during test runs, checkpoints save the last handed over copy
+    bwm = np.copy(runner.bwm)
+    actor_thread = threading.Thread(target=actor, name="actor", daemon=True)
+    actor_thread.start()
+    logger.console_logger.info("Beginning actor-learner training for {} timesteps".format(args.t_max))
+
+    last_log_T = 0
+    model_save_time = 0
+    last_stats = SN(time=time.time(), episodes=0, env_steps=0, updates=0)
+    try:
+        while True:
+            with cond:
+                cond.wait_for(lambda: owed_updates() > 0 or state.done)
+                if owed_updates() <= 0:
+                    break
+                episode = state.episodes
+                test_logs, state.test_logs = state.test_logs, None
+            if test_logs is not None:
+                learner.update_rew_log(test_logs[0])
+                bwm = test_logs[1]
+                learner.update_bwm(bwm)
+
+            train_step(args, buffer, learner, runner.t_env, episode, buffer_lock=buffer_lock)
+
+            with cond:
+                state.updates += 1
+                if state.updates % args.actor_sync_interval == 0:
+                    state.weights = {k: v.detach().clone() for k, v in mac.agent.state_dict().items()}
+                    state.weights_version = state.updates
+                cond.notify_all()
+
+            if args.save_model and (runner.t_env - model_save_time >= args.save_model_interval or model_save_time == 0):
+                model_save_time = runner.t_env
+                save_checkpoint(args, runner, learner, buffer, logger, buffer_lock=buffer_lock, bwm=bwm)
+
+            if (runner.t_env - last_log_T) >= args.log_interval:
+                with cond:
+                    now = time.time()
+                    elapsed = max(now - last_stats.time, 1e-6)
+                    logger.log_stat("episode", state.episodes, runner.t_env)
+                    logger.log_stat("actor_episodes_per_sec", (state.episodes - last_stats.episodes) / elapsed, runner.t_env)
+                    logger.log_stat("actor_steps_per_sec", (state.env_steps - last_stats.env_steps) / elapsed, runner.t_env)
+                    logger.log_stat("learner_updates_per_sec", (state.updates - last_stats.updates) / elapsed, runner.t_env)
+                    if state.policy_lag:
+                        logger.log_stat("actor_policy_lag", np.mean(state.policy_lag), runner.t_env)
+                        state.policy_lag = []
+                    last_stats = SN(time=now, episodes=state.episodes, env_steps=state.env_steps, updates=state.updates)
+                logger.print_recent_stats()
+                last_log_T = runner.t_env
+    finally:
+        # stop the actor if the learner raised, it could be waiting for updates
+        with cond:
+            state.done = True
+            cond.notify_all()
+
+    actor_thread.join()
+    if state.error is not None:
+        raise state.error
+    if args.save_model:
+        save_checkpoint(args, runner, learner, buffer, logger, buffer_lock=buffer_lock)
+
+    runner.close_env()
+    buffer.close()
     logger.console_logger.info("Finished Training")
 
 
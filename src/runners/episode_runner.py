@@ -73,6 +73,12 @@ class EpisodeRunner:
             }
         return pre_transition_data
 
+    def _select_actions(self, pre_transition_data, test_mode):
+        if self.args.runner_mac_stream:
+            # the mac keeps its own hidden and last action state, only the current step is passed
+            return self.mac.select_actions_stream(pre_transition_data, t_env=self.t_env, test_mode=test_mode)
+        return self.mac.select_actions(self.batch, t_ep=self.t, t_env=self.t_env, test_mode=test_mode)
+
     def run(self, test_mode=False, test_scen=None, index=None, vid_writer=None):
         """
         test_mode: whether to use greedy action selection or sample actions
@@ -97,7 +103,7 @@ class EpisodeRunner:
 
             # Pass the entire batch of experiences up till now to the agents
             # Receive the actions for each agent at this timestep in a batch of size 1
-            actions = self.mac.select_actions(self.batch, t_ep=self.t, t_env=self.t_env, test_mode=test_mode)
+            actions = self._select_actions(pre_transition_data, test_mode)
 
             reward, terminated, env_info = self.env.step(actions[0].cpu())
             if vid_writer is not None:
@@ -118,7 +124,7 @@ class EpisodeRunner:
         self.batch.update(last_data, ts=self.t)
 
         # Select actions in the last stored state
-        actions = self.mac.select_actions(self.batch, t_ep=self.t, t_env=self.t_env, test_mode=test_mode)
+        actions = self._select_actions(last_data, test_mode)
         self.batch.update({"actions": actions}, ts=self.t)
 
         cur_stats = self.test_stats if test_mode else self.train_stats
@@ -2,6 +2,8 @@ from envs import REGISTRY as env_REGISTRY
 from functools import partial
 from components.episode_buffer import EpisodeBatch
 from multiprocessing import Pipe, Process
+from multiprocessing.connection import wait
+from multiprocessing.shared_memory import SharedMemory
 import numpy as np
 import torch as th
 from types import SimpleNamespace as SN
@@ -80,6 +82,15 @@ class ParallelRunner:
         self.groups = groups
         self.preprocess = preprocess
 
+        self.transport = None
+        if self.args.runner_shared_memory:
+            # workers write step data into shared arrays and only signal readiness through the pipe
+            self.transport = SharedTransport.create(scheme, groups, self.batch_size, self.args.entity_scheme)
+            for rank, parent_conn in enumerate(self.parent_conns):
+                parent_conn.send(("setup_shm", (self.transport.handles(), rank)))
+            for parent_conn in self.parent_conns:
+                parent_conn.recv()
+
     def get_env_info(self):
         return self.env_info
 
@@ -89,6 +100,9 @@ class ParallelRunner:
     def close_env(self):
         for parent_conn in self.parent_conns:
             parent_conn.send(("close", None))
+        if getattr(self, "transport", None) is not None:
+            self.transport.close(unlink=True)
+            self.transport = None
 
     def reset(self, **kwargs):
         self.batch = self.new_batch()
@@ -100,14 +114,20 @@ class ParallelRunner:
         pre_transition_data = {}
         # Get the obs, state and avail_actions back
         for parent_conn in self.parent_conns:
+            if self.transport is not None:
+                parent_conn.recv_bytes()
+                continue
             data = parent_conn.recv()
             for k, v in data.items():
                 if k in pre_transition_data:
                     pre_transition_data[k].append(data[k])
                 else:
                     pre_transition_data[k] = [data[k]]
+        if self.transport is not None:
+            pre_transition_data = self.transport.read(self.transport.reset_keys)
 
         self.batch.update(pre_transition_data, ts=0)
+        self.pre_transition_data = pre_transition_data
 
         self.t = 0
         self.env_steps_this_run = 0
@@ -125,100 +145,18 @@ class ParallelRunner:
         assert vid_writer is None, "Writing videos not supported for ParallelRunner"
         self.reset(test=test_scen, index=index)
 
-        all_terminated = False
         episode_returns = [0 for _ in range(self.batch_size)]
         episode_lengths = [0 for _ in range(self.batch_size)]
 
         self.mac.init_hidden(batch_size=self.batch_size)
         # make sure things like dropout are disabled
         self.mac.eval()
-        terminated = [False for _ in range(self.batch_size)]
-        envs_not_terminated = [b_idx for b_idx, termed in enumerate(terminated) if not termed]
         final_env_infos = []  # may store extra stats like battle won. this is filled in ORDER OF TERMINATION
 
-        while True:
-
-            # Pass the entire batch of experiences up till now to the agents
-            # Receive the actions for each agent at this timestep in a batch for each un-terminated env
-            actions = self.mac.select_actions(self.batch, t_ep=self.t, t_env=self.t_env, bs=envs_not_terminated,
-                                              test_mode=test_mode)
-            cpu_actions = actions.to("cpu").numpy()
-
-            # Update the actions taken
-            actions_chosen = {
-                "actions": actions.unsqueeze(1)
-            }
-            self.batch.update(actions_chosen, bs=envs_not_terminated, ts=self.t, mark_filled=False)
-
-            # Send actions to each env
-            action_idx = 0
-            for idx, parent_conn in enumerate(self.parent_conns):
-                if idx in envs_not_terminated:  # We produced actions for this env
-                    if not terminated[idx]:  # Only send the actions to the env if it hasn't terminated
-                        parent_conn.send(("step", cpu_actions[action_idx]))
-                    action_idx += 1  # actions is not a list over every env
-
-            # Post step data we will insert for the current timestep
-            post_transition_data = {
-                # "actions": actions.unsqueeze(1),
-                "reward": [],
-                "terminated": []
-            }
-            # Data for the next step we will insert in order to select an action
-            if self.args.entity_scheme:
-                pre_transition_data = {
-                    "entities": [],
-                    "obs_mask": [],
-                    "entity_mask": [],
-                    "avail_actions": []
-                }
-            else:
-                pre_transition_data = {
-                    "state": [],
-                    "avail_actions": [],
-                    "obs": []
-                }
-
-            # Update terminated envs after adding post_transition_data
-            envs_not_terminated = [b_idx for b_idx, termed in enumerate(terminated) if not termed]
-            all_terminated = all(terminated)
-            if all_terminated:
-                break
-
-            # Receive data back for each unterminated env
-            for idx, parent_conn in enumerate(self.parent_conns):
-                if not terminated[idx]:
-                    data = parent_conn.recv()
-                    # Remaining data for this current timestep
-                    post_transition_data["reward"].append((data["reward"],))
-
-                    episode_returns[idx] += data["reward"]
-                    episode_lengths[idx] += 1
-                    if not test_mode:
-                        self.env_steps_this_run += 1
-
-                    env_terminated = False
-                    if data["terminated"]:
-                        final_env_infos.append(data["info"])
-                        self.status_log[idx] = data["info"].get("battle_won", 0)
-                    if data["terminated"] and not data["info"].get("episode_limit", False):
-                        env_terminated = True
-                    terminated[idx] = data["terminated"]
-                    post_transition_data["terminated"].append((env_terminated,))
-
-                    # Data for the next timestep needed to select an action
-                    for k in pre_transition_data:
-                        pre_transition_data[k].append(data[k])
-
-            # Add post_transiton data into the batch
-            self.batch.update(post_transition_data, bs=envs_not_terminated, ts=self.t, mark_filled=False)
-
-            # Move onto the next timestep
-            self.t += 1
-
-            # Add the pre-transition data
-
-            self.batch.update(pre_transition_data, bs=envs_not_terminated, ts=self.t, mark_filled=True)
+        if self.args.runner_async:
+            self._run_async(test_mode, episode_returns, episode_lengths, final_env_infos)
+        else:
+            self._run_sync(test_mode, episode_returns, episode_lengths, final_env_infos)
 
         if not test_mode:
             self.t_env += self.env_steps_this_run
@@ -264,6 +202,191 @@ class ParallelRunner:
 
         return self.batch
 
+    def _run_sync(self, test_mode, episode_returns, episode_lengths, final_env_infos):
+        # every env steps in lockstep, the slowest one sets the pace
+        all_terminated = False
+        terminated = [False for _ in range(self.batch_size)]
+        envs_not_terminated = [b_idx for b_idx, termed in enumerate(terminated) if not termed]
+
+        while True:
+
+            # Pass the entire batch of experiences up till now to the agents
+            # Receive the actions for each agent at this timestep in a batch for each un-terminated env
+            if self.args.runner_mac_stream:
+                # only the current step of the running envs is passed, the mac keeps the rest
+                actions = self.mac.select_actions_stream(self.pre_transition_data, t_env=self.t_env,
+                                                         bs=envs_not_terminated, test_mode=test_mode)
+            else:
+                actions = self.mac.select_actions(self.batch, t_ep=self.t, t_env=self.t_env, bs=envs_not_terminated,
+                                                  test_mode=test_mode)
+            cpu_actions = actions.to("cpu").numpy()
+
+            # Update the actions taken
+            actions_chosen = {
+                "actions": actions.unsqueeze(1)
+            }
+            self.batch.update(actions_chosen, bs=envs_not_terminated, ts=self.t, mark_filled=False)
+
+            # Send actions to each env
+            action_idx = 0
+            for idx, parent_conn in enumerate(self.parent_conns):
+                if idx in envs_not_terminated:  # We produced actions for this env
+                    if not terminated[idx]:  # Only send the actions to the env if it hasn't terminated
+                        parent_conn.send(("step", cpu_actions[action_idx]))
+                    action_idx += 1  # actions is not a list over every env
+
+            # Update terminated envs after adding post_transition_data
+            envs_not_terminated = [b_idx for b_idx, termed in enumerate(terminated) if not termed]
+            all_terminated = all(terminated)
+            if all_terminated:
+                break
+
+            # Receive data back for each unterminated env
+            post_transition_data, pre_transition_data = self._recv(envs_not_terminated, terminated, test_mode,
+                                                                   episode_returns, episode_lengths, final_env_infos)
+
+            # Add post_transiton data into the batch
+            self.batch.update(post_transition_data, bs=envs_not_terminated, ts=self.t, mark_filled=False)
+
+            # Move onto the next timestep
+            self.t += 1
+
+            # Add the pre-transition data
+
+            self.batch.update(pre_transition_data, bs=envs_not_terminated, ts=self.t, mark_filled=True)
+            self.pre_transition_data = pre_transition_data
+
+    def _run_async(self, test_mode, episode_returns, episode_lengths, final_env_infos):
+        """
+        Steps every env at its own pace: replies are consumed in completion order and
+        actions are selected for whichever envs are ready while the others are still stepping.
+        Each env keeps its own timestep in the batch.
+        """
+        terminated = [False for _ in range(self.batch_size)]
+        t_eps = np.zeros(self.batch_size, dtype=np.int64)
+        conn_idx = {parent_conn: idx for idx, parent_conn in enumerate(self.parent_conns)}
+        ready = list(range(self.batch_size))
+        pending = []
+        # current step of the ready envs, in the order of ready
+        step_data = self.pre_transition_data
+
+        while True:
+            if ready:
+                # envs that just terminated still get actions at their final step, like the synchronous loop
+                if self.args.runner_mac_stream:
+                    # the mac keeps hidden states and last actions per env, so any subset can step
+                    actions = self.mac.select_actions_stream(step_data, t_env=self.t_env, bs=ready,
+                                                             test_mode=test_mode)
+                else:
+                    actions = self.mac.select_actions_subset(self.batch, t_eps[ready], t_env=self.t_env, bs=ready,
+                                                             test_mode=test_mode)
+                self._update_per_t({"actions": actions.unsqueeze(1)}, ready, t_eps, mark_filled=False)
+                cpu_actions = actions.to("cpu").numpy()
+                for action_idx, idx in enumerate(ready):
+                    if not terminated[idx]:
+                        self.parent_conns[idx].send(("step", cpu_actions[action_idx]))
+                        pending.append(idx)
+            if not pending:
+                break
+
+            # block until at least one env has replied, then take every reply that is in
+            ready = sorted(conn_idx[conn] for conn in wait([self.parent_conns[idx] for idx in pending]))
+            pending = [idx for idx in pending if idx not in ready]
+            post_transition_data, pre_transition_data = self._recv(ready, terminated, test_mode,
+                                                                   episode_returns, episode_lengths, final_env_infos)
+            self._update_per_t(post_transition_data, ready, t_eps, mark_filled=False)
+            t_eps[ready] += 1
+            self._update_per_t(pre_transition_data, ready, t_eps, mark_filled=True)
+            step_data = pre_transition_data
+
+        self.t = int(t_eps.max())
+
+    def _update_per_t(self, data, envs, t_eps, mark_filled):
+        # one batch update per distinct timestep among envs
+        ts = t_eps[envs]
+        for t in np.unique(ts):
+            sel = np.flatnonzero(ts == t)
+            bs = [envs[i] for i in sel]
+            if len(sel) < len(envs):
+                data_t = {k: v[th.as_tensor(sel, device=v.device)] if th.is_tensor(v) else [v[i] for i in sel]
+                          for k, v in data.items()}
+            else:
+                data_t = data
+            self.batch.update(data_t, bs=bs, ts=int(t), mark_filled=mark_filled)
+
+    def _recv(self, envs, terminated, test_mode, episode_returns, episode_lengths, final_env_infos):
+        """
+        Receives the step results of envs, returns the data for the current timestep
+        and the data for the next timestep needed to select an action.
+        """
+        if self.transport is not None:
+            self._recv_shared(envs, terminated, test_mode, episode_returns, episode_lengths, final_env_infos)
+            return (self.transport.read(["reward", "terminated"], envs),
+                    self.transport.read(self.transport.step_keys, envs))
+
+        # Post step data we will insert for the current timestep
+        post_transition_data = {
+            # "actions": actions.unsqueeze(1),
+            "reward": [],
+            "terminated": []
+        }
+        # Data for the next step we will insert in order to select an action
+        if self.args.entity_scheme:
+            pre_transition_data = {
+                "entities": [],
+                "obs_mask": [],
+                "entity_mask": [],
+                "avail_actions": []
+            }
+        else:
+            pre_transition_data = {
+                "state": [],
+                "avail_actions": [],
+                "obs": []
+            }
+
+        for idx in envs:
+            data = self.parent_conns[idx].recv()
+            # Remaining data for this current timestep
+            post_transition_data["reward"].append((data["reward"],))
+
+            episode_returns[idx] += data["reward"]
+            episode_lengths[idx] += 1
+            if not test_mode:
+                self.env_steps_this_run += 1
+
+            env_terminated = False
+            if data["terminated"]:
+                final_env_infos.append(data["info"])
+                self.status_log[idx] = data["info"].get("battle_won", 0)
+            if data["terminated"] and not data["info"].get("episode_limit", False):
+                env_terminated = True
+            terminated[idx] = data["terminated"]
+            post_transition_data["terminated"].append((env_terminated,))
+
+            # Data for the next timestep needed to select an action
+            for k in pre_transition_data:
+                pre_transition_data[k].append(data[k])
+        return post_transition_data, pre_transition_data
+
+    def _recv_shared(self, envs, terminated, test_mode, episode_returns, episode_lengths, final_env_infos):
+        # envs that just stepped signal with a single byte, or send their info dict when they terminate
+        reward = self.transport.arrays["reward"]
+        env_terminated = self.transport.arrays["terminated"]
+        for idx in envs:
+            msg = self.parent_conns[idx].recv_bytes()
+            if msg != b"\x01":
+                info = pickle.loads(msg)
+                final_env_infos.append(info)
+                self.status_log[idx] = info.get("battle_won", 0)
+                # the worker only knows the env terminated, hitting the episode limit is not a real termination
+                env_terminated[idx] = not info.get("episode_limit", False)
+                terminated[idx] = True
+            episode_returns[idx] += float(reward[idx, 0])
+            episode_lengths[idx] += 1
+            if not test_mode:
+                self.env_steps_this_run += 1
+
     def _log(self, returns, stats, prefix):
         self.logger.log_stat(prefix + "return_mean", np.mean(returns), self.t_env)
         self.logger.log_stat(prefix + "return_std", np.std(returns), self.t_env)
@@ -292,69 +415,54 @@ class ParallelRunner:
 def env_worker(remote, entity_scheme, env_fn):
     # Make environment
     env = env_fn.x()
+    transport = None
+    rank = None
     while True:
         cmd, data = remote.recv()
         if cmd == "step":
             actions = data
             # Take a step in the environment
             reward, terminated, env_info = env.step(actions)
+            if transport is not None:
+                transport.write(rank, next_step_data(env, entity_scheme), reward=reward, terminated=terminated)
+                if terminated:
+                    remote.send(env_info)
+                else:
+                    remote.send_bytes(b"\x01")
+                continue
             send_dict = {
-                "avail_actions": env.get_avail_actions(),
                 # Rest of the data for the current timestep
                 "reward": reward,
                 "terminated": terminated,
                 "info": env_info
             }
-            if entity_scheme:
-                masks = env.get_masks()
-                if len(masks) == 2:
-                    obs_mask, entity_mask = masks
-                    gt_mask = None
-                else:
-                    obs_mask, entity_mask, gt_mask = masks
-                send_dict["obs_mask"] = obs_mask
-                send_dict["entity_mask"] = entity_mask
-                if gt_mask is not None:
-                    send_dict["gt_mask"] = gt_mask
-                send_dict["entities"] = env.get_entities()
-            else:
-                # Data for the next timestep needed to pick an action
-                send_dict["state"] = env.get_state()
-                send_dict["obs"] = env.get_obs()
+            # Data for the next timestep needed to pick an action
+            send_dict.update(next_step_data(env, entity_scheme))
             remote.send(send_dict)
         elif cmd == "reset":
             env.reset(**data)
+            send_dict = next_step_data(env, entity_scheme)
             if entity_scheme:
-                masks = env.get_masks()
-                if len(masks) == 2:
-                    obs_mask, entity_mask = masks
-                    gt_mask = None
-                else:
-                    obs_mask, entity_mask, gt_mask = masks
-                send_dict = {
-                    "entities": env.get_entities(),
-                    "avail_actions": env.get_avail_actions(),
-                    "obs_mask": obs_mask,
-                    "entity_mask": entity_mask,
-                    "scenario": env.get_scenario(),
-                }
-                if gt_mask is not None:
-                    send_dict["gt_mask"] = gt_mask
-                remote.send(send_dict)
+                send_dict["scenario"] = env.get_scenario()
+            if transport is not None:
+                transport.write(rank, send_dict)
+                remote.send_bytes(b"\x01")
             else:
-                remote.send({
-                    "state": env.get_state(),
-                    "avail_actions": env.get_avail_actions(),
-                    "obs": env.get_obs()
-                })
+                remote.send(send_dict)
         elif cmd == "close":
             env.close()
+            if transport is not None:
+                transport.close()
             remote.close()
             break
         elif cmd == "get_env_info":
             remote.send(env.get_env_info(data))
         elif cmd == "get_stats":
             remote.send(env.get_stats())
+        elif cmd == "setup_shm":
+            handles, rank = data
+            transport = SharedTransport.attach(handles)
+            remote.send(True)
         # TODO: unused now?
         # elif cmd == "agg_stats":
         #     agg_stats = env.get_agg_stats(data)
@@ -363,6 +471,102 @@ def env_worker(remote, entity_scheme, env_fn):
             raise NotImplementedError
 
 
+def next_step_data(env, entity_scheme):
+    if not entity_scheme:
+        return {
+            "state": env.get_state(),
+            "avail_actions": env.get_avail_actions(),
+            "obs": env.get_obs()
+        }
+    masks = env.get_masks()
+    if len(masks) == 2:
+        obs_mask, entity_mask = masks
+        gt_mask = None
+    else:
+        obs_mask, entity_mask, gt_mask = masks
+    data = {
+        "entities": env.get_entities(),
+        "avail_actions": env.get_avail_actions(),
+        "obs_mask": obs_mask,
+        "entity_mask": entity_mask,
+    }
+    if gt_mask is not None:
+        data["gt_mask"] = gt_mask
+    return data
+
+
+class SharedTransport:
+    """
+    Shared-memory arrays of shape (batch_size_run, *vshape) for the per-step env data,
+    one row per env slot. The runner creates the blocks and reads whole batches from them,
+    each worker attaches by name and writes its own row in place of pickling a dict.
+    """
+
+    def __init__(self, blocks, specs):
+        self.blocks = blocks
+        self.specs = specs
+        self.arrays = {k: np.ndarray(shape, dtype=dtype, buffer=blocks[k].buf)
+                       for k, (shape, dtype) in specs.items()}
+
+    @classmethod
+    def create(cls, scheme, groups, batch_size, entity_scheme):
+        if entity_scheme:
+            step_keys = ["entities", "obs_mask", "entity_mask", "avail_actions"]
+            if "gt_mask" in scheme:
+                step_keys.append("gt_mask")
+            reset_keys = step_keys + ["scenario"]
+        else:
+            step_keys = reset_keys = ["state", "avail_actions", "obs"]
+
+        specs = {}
+        for k in reset_keys + ["reward", "terminated"]:
+            vshape = scheme[k]["vshape"]
+            vshape = (vshape,) if isinstance(vshape, int) else tuple(vshape)
+            if "group" in scheme[k]:
+                vshape = (groups[scheme[k]["group"]],) + vshape
+            dtype = th.empty(0, dtype=scheme[k].get("dtype", th.float32)).numpy().dtype
+            if k == "reward":
+                # keep full precision for the episode returns, the batch casts it down anyway
+                dtype = np.dtype(np.float64)
+            specs[k] = ((batch_size,) + vshape, dtype)
+        blocks = {k: SharedMemory(create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+                  for k, (shape, dtype) in specs.items()}
+        transport = cls(blocks, specs)
+        transport.step_keys = step_keys
+        transport.reset_keys = reset_keys
+        return transport
+
+    @classmethod
+    def attach(cls, handles):
+        # workers inherit the runner's resource tracker (fork and spawn alike), so attaching only
+        # re-registers the runner's own entry. The runner unlinks the blocks on close, and the
+        # tracker does if the runner dies first; unregistering here would drop that entry.
+        blocks = {k: SharedMemory(name=name) for k, (name, _, _) in handles.items()}
+        return cls(blocks, {k: (shape, dtype) for k, (_, shape, dtype) in handles.items()})
+
+    def handles(self):
+        return {k: (self.blocks[k].name, shape, dtype) for k, (shape, dtype) in self.specs.items()}
+
+    def write(self, rank, data, **scalars):
+        for k, v in data.items():
+            self.arrays[k][rank] = v
+        for k, v in scalars.items():
+            self.arrays[k][rank] = v
+
+    def read(self, keys, bs=None):
+        # copies, so workers can overwrite their rows while the batch is being built
+        if bs is None:
+            return {k: th.from_numpy(self.arrays[k].copy()) for k in keys}
+        return {k: th.from_numpy(self.arrays[k][bs]) for k in keys}
+
+    def close(self, unlink=False):
+        self.arrays = {}
+        for block in self.blocks.values():
+            block.close()
+            if unlink:
+                block.unlink()
+
+
 class CloudpickleWrapper():
     """
     Uses cloudpickle to serialize contents (otherwise multiprocessing tries to use pickle)
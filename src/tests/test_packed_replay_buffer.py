@@ -0,0 +1,77 @@
+import numpy as np
+import torch as th
+
+from components.episode_buffer import EpisodeBatch, PackedReplayBuffer
+
+SCHEME = {
+    "obs": {"vshape": (3,)},
+    "actions": {"vshape": (1,), "dtype": th.long},
+    "scenario": {"vshape": (2,), "episode_const": True},
+}
+MAX_T = 6
+
+
+def make_batch(rs, lengths):
+    batch = EpisodeBatch(SCHEME, {}, len(lengths), MAX_T)
+    for i, ep_len in enumerate(lengths):
+        batch.update({"obs": th.tensor(rs.randn(ep_len, 3), dtype=th.float32),
+                      "actions": th.tensor(rs.randint(0, 5, (ep_len, 1)))},
+                     bs=[i], ts=slice(0, ep_len))
+        batch.update({"scenario": th.tensor(rs.randn(1, 2), dtype=th.float32)}, bs=[i])
+    return batch
+
+
+def episode(batch, i, ep_len):
+    return {"obs": batch["obs"][i, :ep_len], "actions": batch["actions"][i, :ep_len],
+            "scenario": batch["scenario"][i]}
+
+
+def check_valid_episodes(buffer, inserted):
+    valid = np.flatnonzero(buffer._ep_valid)
+    assert buffer.episodes_in_buffer == len(valid)
+    for slot in valid:
+        expected = inserted[slot]
+        ep_len = len(expected["obs"])
+        assert buffer._ep_lengths[slot] == ep_len
+        got = buffer._gather(np.array([slot]))
+        for k, v in expected.items():
+            v_got = got[k][0, :ep_len] if k != "scenario" else got[k][0]
+            assert th.equal(v_got, v), (slot, k)
+
+
+def test_batch_wrapping_past_the_end_does_not_overlap():
+    # capacity 10 with 4 rows used: a [3, 5] batch can't fit at the end and must wrap as a whole
+    rs = np.random.RandomState(0)
+    buffer = PackedReplayBuffer(SCHEME, {}, 4, MAX_T, transition_capacity=10)
+    inserted = {}
+    first = make_batch(rs, [4])
+    buffer.insert_episode_batch(first)
+    inserted[0] = episode(first, 0, 4)
+    batch = make_batch(rs, [3, 5])
+    buffer.insert_episode_batch(batch)
+    inserted[1] = episode(batch, 0, 3)
+    inserted[2] = episode(batch, 1, 5)
+    assert not buffer._ep_valid[0]
+    assert buffer._ep_valid[1] and buffer._ep_valid[2]
+    check_valid_episodes(buffer, inserted)
+
+
+def test_random_batches_across_the_wrap_point_read_back_exactly():
+    rs = np.random.RandomState(1)
+    buffer = PackedReplayBuffer(SCHEME, {}, 7, MAX_T, transition_capacity=18)
+    inserted = {}
+    for _ in range(60):
+        lengths = list(rs.randint(1, MAX_T + 1, size=rs.randint(2, 4)))
+        batch = make_batch(rs, lengths)
+        slots = (buffer.buffer_index + np.arange(len(lengths))) % buffer.buffer_size
+        buffer.insert_episode_batch(batch)
+        for i, (slot, ep_len) in enumerate(zip(slots, lengths)):
+            inserted[slot] = episode(batch, i, ep_len)
+            # the episodes just inserted are always kept
+            assert buffer._ep_valid[slot]
+        # no two valid episodes share a transition row
+        valid = np.flatnonzero(buffer._ep_valid)
+        rows = np.concatenate([np.arange(buffer._ep_start[s], buffer._ep_start[s] + buffer._ep_lengths[s])
+                               for s in valid])
+        assert len(rows) == len(np.unique(rows))
+        check_valid_episodes(buffer, inserted)
@@ -0,0 +1,58 @@
+import gc
+
+import torch as th
+
+from components.episode_buffer import EpisodeBatch, PackedReplayBuffer, ReplayBuffer
+
+SCHEME = {
+    "obs": {"vshape": (3,)},
+    "scenario": {"vshape": (2,), "episode_const": True},
+}
+MAX_T = 4
+
+
+def make_buffer(storage_dir, packed=False, **kwargs):
+    if packed:
+        return PackedReplayBuffer(SCHEME, {}, 4, MAX_T, transition_capacity=8, storage_dir=str(storage_dir), **kwargs)
+    return ReplayBuffer(SCHEME, {}, 4, MAX_T, storage_dir=str(storage_dir), **kwargs)
+
+
+def test_close_removes_storage(tmp_path):
+    storage_dir = tmp_path / "run"
+    for packed in (False, True):
+        buffer = make_buffer(storage_dir, packed=packed)
+        batch = EpisodeBatch(SCHEME, {}, 2, MAX_T)
+        batch.update({"obs": th.ones(2, MAX_T, 3)}, ts=slice(0, MAX_T))
+        buffer.insert_episode_batch(batch)
+        assert sorted(p.name for p in storage_dir.iterdir()) == ["filled.dat", "obs.dat", "scenario.dat"]
+        buffer.close()
+        assert not storage_dir.exists()
+        # mapped data stays readable until the buffer is dropped
+        assert buffer.sample(2)["obs"].sum().item() == 2 * MAX_T * 3
+
+
+def test_storage_removed_when_buffer_is_dropped(tmp_path):
+    storage_dir = tmp_path / "run"
+    buffer = make_buffer(storage_dir)
+    assert storage_dir.exists()
+    del buffer
+    gc.collect()
+    assert not storage_dir.exists()
+
+
+def test_keep_storage(tmp_path):
+    storage_dir = tmp_path / "run"
+    buffer = make_buffer(storage_dir, keep_storage=True)
+    buffer.close()
+    del buffer
+    gc.collect()
+    assert (storage_dir / "obs.dat").exists()
+
+
+def test_other_files_in_storage_dir_are_left(tmp_path):
+    storage_dir = tmp_path / "run"
+    storage_dir.mkdir()
+    (storage_dir / "notes.txt").write_text("not ours")
+    buffer = make_buffer(storage_dir)
+    buffer.close()
+    assert [p.name for p in storage_dir.iterdir()] == ["notes.txt"]
@@ -0,0 +1,87 @@
+from collections import Counter
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+pytest.importorskip("pysc2")
+from pysc2.lib.units import Terran  # noqa: E402
+
+from envs.starcraft2.starcraft2custom import Direction, StarCraft2CustomEnv  # noqa: E402
+from envs.starcraft2.unit_table import UnitTable  # noqa: E402
+
+
+def make_env(seed, unit_types, n_agents=5, n_enemies=6, n_extra_tags=2):
+    """Env with random units placed on a 32x32 map, without launching SC2."""
+    rs = np.random.RandomState(seed)
+    env = StarCraft2CustomEnv.__new__(StarCraft2CustomEnv)
+    env.n_agents, env.n_enemies = n_agents, n_enemies
+    env.max_n_agents, env.max_n_enemies = n_agents + 1, n_enemies + 1
+    env.unit_types = set(unit_types)
+    env.medivac_id = 1940
+    env.n_actions_no_attack = 6
+    if Terran.Medivac in env.unit_types:
+        env.n_actions = 6 + env.max_n_enemies + env.max_n_agents + 2 * n_extra_tags
+    else:
+        # without medivacs the ally tags index past the action space
+        env.n_actions = 6 + env.max_n_enemies + n_extra_tags
+    env.ally_tags = env.max_n_enemies + n_extra_tags + rs.permutation(env.max_n_agents + n_extra_tags)[:n_agents]
+    env.enemy_tags = rs.permutation(env.max_n_enemies + n_extra_tags)[:n_enemies]
+    env.map_x = env.map_y = 32
+    env._move_amount = 2
+    env.pathing_grid = rs.rand(32, 32) < 0.8
+    env.spatial_grid = False
+    env._step_cache, env.step_cache_hits, env.step_cache_misses = {}, Counter(), Counter()
+
+    units = []
+    for i in range(n_agents + n_enemies):
+        unit_type = int(rs.choice(sorted(unit_types)))
+        units.append(SimpleNamespace(
+            tag=100 + i, unit_type=unit_type, pos=SimpleNamespace(x=rs.rand() * 32, y=rs.rand() * 32),
+            health=float(rs.choice([0, 20, 45])), health_max=45.0, shield=0.0, shield_max=0.0,
+            energy=0.0, energy_max=0.0, weapon_cooldown=0.0, is_flying=unit_type == Terran.Medivac))
+    env.agents = dict(enumerate(units[:n_agents]))
+    env.enemies = dict(enumerate(units[n_agents:]))
+    env.units = UnitTable(units)
+    env.shoot_ranges = np.full(n_agents, 6)
+    env.is_medivac = np.isin(env.units.unit_type[:n_agents], (env.medivac_id, Terran.Medivac))
+    env._calc_distance_mtx()
+    return env
+
+
+def per_unit_avail_actions(env):
+    """Available actions as computed by the per-agent loop the env used before vectorising."""
+    avail_actions = []
+    for agent_id in range(env.max_n_agents):
+        if agent_id >= env.n_agents or env.agents[agent_id].health <= 0:
+            avail_actions.append([1] + [0] * (env.n_actions - 1))
+            continue
+        unit = env.agents[agent_id]
+        avail = [0] * env.n_actions
+        avail[1] = 1
+        for i, direction in enumerate((Direction.NORTH, Direction.SOUTH, Direction.EAST, Direction.WEST)):
+            avail[2 + i] = int(env.can_move(unit, direction))
+        shoot_range = env.unit_shoot_range(agent_id)
+        if unit.unit_type in (env.medivac_id, Terran.Medivac):
+            target_items = [(t_id, t_unit) for t_id, t_unit in env.agents.items() if not t_unit.is_flying]
+            dist_offset, tags = 0, env.ally_tags
+        else:
+            target_items = list(env.enemies.items())
+            dist_offset, tags = env.n_agents, env.enemy_tags
+        for t_id, t_unit in target_items:
+            if env.dist_mtx[agent_id, t_id + dist_offset] <= shoot_range:
+                avail[tags[t_id] + env.n_actions_no_attack] = 1
+        avail_actions.append(avail)
+    return np.array(avail_actions)
+
+
+@pytest.mark.parametrize("unit_types", [
+    (Terran.Marine, Terran.Marauder, Terran.Medivac),
+    (Terran.Marine, Terran.Marauder),
+])
+def test_avail_actions_match_per_unit_loop(unit_types):
+    for seed in range(20):
+        env = make_env(seed, unit_types)
+        avail_actions = env.get_avail_actions()
+        assert avail_actions.shape == (env.max_n_agents, env.n_actions)
+        np.testing.assert_array_equal(avail_actions, per_unit_avail_actions(env))
@@ -0,0 +1,94 @@
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("pysc2")
+from pysc2.lib import protocol  # noqa: E402
+
+from envs.starcraft2.process_pool import SC2ProcessPool  # noqa: E402
+
+
+class StubProc:
+    def __init__(self):
+        self.closed = threading.Event()
+
+    def close(self):
+        self.closed.set()
+
+
+class StubController:
+    def __init__(self):
+        self.alive = True
+
+    def ping(self):
+        if not self.alive:
+            raise protocol.ProtocolError("stub instance died")
+
+
+class StubLauncher:
+    """launch_fn that hands out stub instances, failing while fail is set."""
+    def __init__(self):
+        self.launched = []
+        self.fail = False
+
+    def __call__(self):
+        if self.fail:
+            raise RuntimeError("stub launch failed")
+        spare = (StubProc(), StubController())
+        self.launched.append(spare)
+        return spare
+
+
+def wait_for(cond, timeout=5.0):
+    end = time.time() + timeout
+    while not cond():
+        assert time.time() < end, "timed out"
+        time.sleep(0.01)
+
+
+def test_swap_replaces_broken_instance_and_relaunches():
+    launcher = StubLauncher()
+    pool = SC2ProcessPool(launcher, n_spares=1, ping_interval=60)
+    try:
+        proc, controller = pool.take()
+        spare = pool.swap(proc)
+        assert spare is not (proc, controller)
+        assert spare in launcher.launched
+        proc.closed.wait(5)
+        assert proc.closed.is_set()
+        assert pool.stats["swaps"] == 1
+        # the taken spare is replaced in the background
+        wait_for(lambda: len(launcher.launched) == 3)
+    finally:
+        pool.close()
+
+
+def test_ping_failure_drops_and_replaces_spare():
+    launcher = StubLauncher()
+    pool = SC2ProcessPool(launcher, n_spares=1, ping_interval=0.05)
+    try:
+        wait_for(lambda: len(launcher.launched) == 1)
+        proc, controller = launcher.launched[0]
+        controller.alive = False
+        wait_for(lambda: pool.stats["ping_failures"] >= 1)
+        assert proc.closed.wait(5)
+        wait_for(lambda: len(launcher.launched) >= 2)
+        assert pool.take() is not launcher.launched[0]
+    finally:
+        pool.close()
+
+
+def test_launch_failures_are_raised_from_take():
+    launcher = StubLauncher()
+    launcher.fail = True
+    pool = SC2ProcessPool(launcher, n_spares=1, ping_interval=60, max_launch_failures=2, retry_delay=0.01)
+    try:
+        with pytest.raises(RuntimeError, match="stub launch failed"):
+            pool.take()
+        assert pool.stats["launch_failures"] >= 2
+        # once launches work again the pool recovers
+        launcher.fail = False
+        assert pool.take() in launcher.launched
+    finally:
+        pool.close()
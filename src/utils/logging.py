@@ -1,5 +1,6 @@
 from collections import defaultdict
 import logging
+import threading
 import numpy as np
 
 class Logger:
@@ -11,6 +12,8 @@ class Logger:
         self.use_hdf = False
 
         self.stats = defaultdict(lambda: [])
+        # stats may be logged from an actor thread while the learner thread prints them
+        self.lock = threading.Lock()
 
     def setup_tb(self, directory_name):
         # Import here so it doesn't have to be installed if you don't use it
@@ -26,47 +29,50 @@ class Logger:
     # TODO: Setup hdf logger
 
     def log_stat(self, key, value, t, to_sacred=True):
-        self.stats[key].append((t, value))
+        with self.lock:
+            self.stats[key].append((t, value))
 
-        if self.use_tb:
-            self.tb_logger(key, value, t)
+            if self.use_tb:
+                self.tb_logger(key, value, t)
 
-        if self.use_sacred and to_sacred:
-            if key in self.sacred_info:
-                self.sacred_info["{}_T".format(key)].append(t)
-                self.sacred_info[key].append(value)
-            else:
-                self.sacred_info["{}_T".format(key)] = [t]
-                self.sacred_info[key] = [value]
+            if self.use_sacred and to_sacred:
+                if key in self.sacred_info:
+                    self.sacred_info["{}_T".format(key)].append(t)
+                    self.sacred_info[key].append(value)
+                else:
+                    self.sacred_info["{}_T".format(key)] = [t]
+                    self.sacred_info[key] = [value]
 
     def print_recent_stats(self):
-        log_str = "Recent Stats | t_env: {:>10} | Episode: {:>8}\n".format(*self.stats["episode"][-1])
-        i = 0
-        for (k, v) in sorted(self.stats.items()):
-            if k == "episode":
-                continue
-            i += 1
-            window = 5 if k != "epsilon" else 1
-            item = "{:.4f}".format(np.mean([x[1] for x in self.stats[k][-window:]]))
-            log_str += "{:<25}{:>8}".format(k + ":", item)
-            log_str += "\n" if i % 4 == 0 else "\t"
-        self.console_logger.info(log_str)
+        with self.lock:
+            log_str = "Recent Stats | t_env: {:>10} | Episode: {:>8}\n".format(*self.stats["episode"][-1])
+            i = 0
+            for (k, v) in sorted(self.stats.items()):
+                if k == "episode":
+                    continue
+                i += 1
+                window = 5 if k != "epsilon" else 1
+                item = "{:.4f}".format(np.mean([x[1] for x in self.stats[k][-window:]]))
+                log_str += "{:<25}{:>8}".format(k + ":", item)
+                log_str += "\n" if i % 4 == 0 else "\t"
+            self.console_logger.info(log_str)
 
     def print_stats_summary(self):
-        log_str = "Summary Stats"
-        i = 0
-        for (k, v) in sorted(self.stats.items()):
-            if k == "episode":
-                continue
-            i += 1
-            mean_value = np.mean([x[1] for x in self.stats[k]], axis=0)
-            if len(mean_value.shape) == 0:
-                item = "{:.4f}".format(mean_value)
-            else:
-                item = mean_value.__repr__()
-            log_str += "{:<25}{:>8}".format(k + ":", item)
-            log_str += "\n" if i % 4 == 0 else "\t"
-        self.console_logger.info(log_str)
+        with self.lock:
+            log_str = "Summary Stats"
+            i = 0
+            for (k, v) in sorted(self.stats.items()):
+                if k == "episode":
+                    continue
+                i += 1
+                mean_value = np.mean([x[1] for x in self.stats[k]], axis=0)
+                if len(mean_value.shape) == 0:
+                    item = "{:.4f}".format(mean_value)
+                else:
+                    item = mean_value.__repr__()
+                log_str += "{:<25}{:>8}".format(k + ":", item)
+                log_str += "\n" if i % 4 == 0 else "\t"
+            self.console_logger.info(log_str)
 
 # set up a custom logger
 def get_logger():